@@ -0,0 +1,90 @@
+import gzip
+import hashlib
+
+import brotli
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+from backend.metrics import record_cache_lookup
+
+from .versions import get_version
+
+ENCODINGS = (
+    ('br', brotli.compress),
+    ('gzip', gzip.compress),
+)
+
+
+def get_accepted_encodings(request):
+    accepted = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class CachedCatalogMixin:
+    catalog_name = None
+
+    def render_catalog(self):
+        serializer = self.get_serializer(
+            self.filter_queryset(self.get_queryset()), many=True
+        )
+        body = JSONRenderer().render(serializer.data)
+        return hashlib.sha256(body).hexdigest()[:32], body
+
+    def get_catalog_digest(self, version):
+        cache_key = f'catalog:{self.catalog_name}:{version}'
+        digest = record_cache_lookup('catalog', cache.get(cache_key))
+        body = None
+        if digest is None:
+            digest, body = self.render_catalog()
+            cache.set(cache_key, digest, settings.VERSION_STAMP_TIMEOUT)
+        return digest, body
+
+    def get_catalog_payload(self, digest, body=None):
+        cache_key = f'catalog:{self.catalog_name}:payload:{digest}'
+        payload = cache.get(cache_key)
+        if payload is None:
+            if body is None:
+                digest, body = self.render_catalog()
+                cache_key = f'catalog:{self.catalog_name}:payload:{digest}'
+            payload = {'identity': body}
+            for coding, compress in ENCODINGS:
+                payload[coding] = compress(body)
+            cache.set(cache_key, payload, None)
+        return digest, payload
+
+    def catalog_response(self, request):
+        digest, body = self.get_catalog_digest(
+            get_version(self.catalog_name)
+        )
+        accepted = get_accepted_encodings(request)
+        coding = next(
+            (coding for coding, _ in ENCODINGS if coding in accepted),
+            'identity'
+        )
+        etag = f'"{self.catalog_name}-{digest}-{coding}"'
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in (tag.strip() for tag in if_none_match.split(',')):
+            response = HttpResponseNotModified()
+        else:
+            digest, payload = self.get_catalog_payload(digest, body)
+            etag = f'"{self.catalog_name}-{digest}-{coding}"'
+            response = HttpResponse(
+                payload[coding], content_type='application/json'
+            )
+            if coding != 'identity':
+                response['Content-Encoding'] = coding
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.catalog_response(request)
@@ -0,0 +1,87 @@
+import csv
+import json
+from io import BytesIO
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from rest_framework.exceptions import APIException
+
+
+class ExportFailed(APIException):
+    default_detail = 'Не удалось сформировать файл списка покупок.'
+    default_code = 'export_failed'
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+class ShoppingListExporter:
+    content_type = 'text/plain; charset=utf-8'
+    extension = 'txt'
+    streaming = True
+
+    def render(self, rows):
+        for name, amount, measurement_unit in rows:
+            yield f'{name}: {amount} {measurement_unit}\n'
+
+
+class CsvShoppingListExporter(ShoppingListExporter):
+    content_type = 'text/csv; charset=utf-8'
+    extension = 'csv'
+
+    def render(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(('name', 'amount', 'measurement_unit'))
+        for row in rows:
+            yield writer.writerow(row)
+
+
+class JsonLinesShoppingListExporter(ShoppingListExporter):
+    content_type = 'application/x-ndjson'
+    extension = 'ndjson'
+
+    def render(self, rows):
+        for name, amount, measurement_unit in rows:
+            yield json.dumps({
+                'name': name,
+                'amount': amount,
+                'measurement_unit': measurement_unit,
+            }, ensure_ascii=False) + '\n'
+
+
+class PdfShoppingListExporter(ShoppingListExporter):
+    content_type = 'application/pdf'
+    extension = 'pdf'
+    streaming = False
+    template_name = 'recipes/recipe_pdf_template.html'
+
+    def render(self, rows):
+        from xhtml2pdf import pisa
+
+        data_objects = {}
+        for name, amount, measurement_unit in rows:
+            key = name
+            if key in data_objects:
+                key = f'{name} ({measurement_unit})'
+            data_objects[key] = (amount, measurement_unit)
+        html = render_to_string(self.template_name, {
+            'data_objects': data_objects,
+            'font_dir': settings.PDF_FONT_DIR,
+        })
+        buffer = BytesIO()
+        result = pisa.CreatePDF(html, dest=buffer, encoding='utf-8')
+        if result.err:
+            raise ExportFailed
+        yield buffer.getvalue()
+
+
+EXPORTERS = {
+    'txt': ShoppingListExporter(),
+    'csv': CsvShoppingListExporter(),
+    'json': JsonLinesShoppingListExporter(),
+    'ndjson': JsonLinesShoppingListExporter(),
+    'pdf': PdfShoppingListExporter(),
+}
+DEFAULT_EXPORT_FORMAT = 'txt'
@@ -1,9 +1,43 @@
-from django_filters.rest_framework import DjangoFilterBackend
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            TrigramSimilarity)
+from django.db.models import F, Q
+from rest_framework.exceptions import ParseError
+from rest_framework.filters import BaseFilterBackend
 
 
-class IngredientFilterBackend(DjangoFilterBackend):
+class RecipeSearchFilter(BaseFilterBackend):
+    search_param = 'search'
+    search_config = 'russian'
+
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '').strip()
+        if not term:
+            return queryset
+        query = SearchQuery(
+            term, config=self.search_config, search_type='websearch'
+        )
+        return queryset.filter(
+            Q(search_vector=query) | Q(name__trigram_similar=term)
+        ).annotate(
+            rank=(
+                SearchRank(F('search_vector'), query)
+                + TrigramSimilarity('name', term)
+            )
+        ).order_by('-rank', '-id')
+
+
+class RecipeOrderingFilter(BaseFilterBackend):
+    ordering_param = 'ordering'
+    ordering_fields = ('favorites_count', 'in_carts_count')
+
     def filter_queryset(self, request, queryset, view):
-        name = request.query_params.get('name')
-        if name:
-            return queryset.filter(name__istartswith=name)
-        return queryset
+        ordering = request.query_params.get(self.ordering_param)
+        if not ordering:
+            return queryset
+        if ordering.lstrip('-') not in self.ordering_fields:
+            raise ParseError(
+                'Сортировка возможна только по полям: '
+                f'{", ".join(self.ordering_fields)}'
+            )
+        direction = '-' if ordering.startswith('-') else ''
+        return queryset.order_by(ordering, f'{direction}id')
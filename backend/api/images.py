@@ -0,0 +1,111 @@
+import base64
+import binascii
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from PIL import Image
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
+
+
+class ImageTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Размер изображения превышает допустимый.'
+    default_code = 'image_too_large'
+
+
+class LengthRequired(APIException):
+    status_code = status.HTTP_411_LENGTH_REQUIRED
+    default_detail = 'Требуется заголовок Content-Length.'
+    default_code = 'length_required'
+
+
+class LimitedUploadHandler(TemporaryFileUploadHandler):
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.RECIPE_IMAGE_MAX_SIZE:
+            raise ImageTooLarge
+        return super().receive_data_chunk(raw_data, start)
+
+
+def validate_image(file):
+    if file.size > settings.RECIPE_IMAGE_MAX_SIZE:
+        raise serializers.ValidationError(ImageTooLarge.default_detail)
+    try:
+        with Image.open(file) as image:
+            image_format = image.format
+            width, height = image.size
+            if image_format not in settings.RECIPE_IMAGE_FORMATS:
+                raise serializers.ValidationError(
+                    'Неподдерживаемый формат изображения. Допустимые '
+                    f'форматы: {", ".join(settings.RECIPE_IMAGE_FORMATS)}'
+                )
+            max_side = settings.RECIPE_IMAGE_MAX_SIDE
+            if width > max_side or height > max_side:
+                raise serializers.ValidationError(
+                    f'Сторона изображения не должна превышать {max_side} px.'
+                )
+            image.verify()
+    except (OSError, SyntaxError, Image.DecompressionBombError):
+        raise serializers.ValidationError('Файл не является изображением.')
+    finally:
+        file.seek(0)
+
+
+class LimitedImageField(serializers.ImageField):
+    def to_internal_value(self, data):
+        if hasattr(data, 'size'):
+            validate_image(data)
+        return super().to_internal_value(data)
+
+
+class Base64ImageField(LimitedImageField):
+    def to_internal_value(self, data):
+        if isinstance(data, str) and data.startswith('data:image'):
+            format, _, imgstr = data.partition(';base64,')
+            if len(imgstr) * 3 // 4 > settings.RECIPE_IMAGE_MAX_SIZE:
+                raise serializers.ValidationError(
+                    ImageTooLarge.default_detail
+                )
+            try:
+                content = base64.b64decode(imgstr, validate=True)
+            except binascii.Error:
+                raise serializers.ValidationError(
+                    'Файл не является изображением.'
+                )
+            ext = format.split('/')[-1]
+            data = ContentFile(content, name='temp.' + ext)
+        return super().to_internal_value(data)
+
+
+class ImageVariantsField(serializers.Field):
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, variants):
+        if not variants:
+            return None
+        request = self.context.get('request')
+        srcset = {}
+        for source in variants['sources']:
+            url = default_storage.url(source['name'])
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            srcset.setdefault(source['format'], []).append(
+                f'{url} {source["width"]}w'
+            )
+        return {
+            'placeholder': variants.get('placeholder'),
+            'srcset': {
+                image_format: ', '.join(sources)
+                for image_format, sources in srcset.items()
+            },
+        }
@@ -0,0 +1,50 @@
+from bisect import bisect_left
+from threading import Lock
+
+from recipes.models import Ingredient
+
+from .versions import get_version
+
+
+def fold(value):
+    return value.casefold().replace('ё', 'е')
+
+
+class IngredientPrefixIndex:
+    def __init__(self):
+        self._lock = Lock()
+        self._index = ((), (), None)
+
+    def _build(self, version):
+        rows = sorted(
+            (fold(name), name, pk, measurement_unit)
+            for pk, name, measurement_unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit'
+            )
+        )
+        keys = tuple(row[0] for row in rows)
+        items = tuple(
+            {'id': pk, 'name': name, 'measurement_unit': measurement_unit}
+            for _, name, pk, measurement_unit in rows
+        )
+        self._index = (keys, items, version)
+
+    def _get_index(self):
+        version = get_version('ingredients')
+        if self._index[2] != version:
+            with self._lock:
+                if self._index[2] != version:
+                    self._build(version)
+        return self._index
+
+    def search(self, prefix, limit=None):
+        keys, items, _ = self._get_index()
+        prefix = fold(prefix)
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + '\U0010ffff', start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return list(items[start:end])
+
+
+ingredient_index = IngredientPrefixIndex()
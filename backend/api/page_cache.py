@@ -0,0 +1,44 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+from backend.metrics import record_cache_lookup
+
+from .versions import get_version
+
+
+class AnonymousPageCacheMixin:
+    page_cache_version = None
+    page_cache_params = ()
+
+    def get_page_cache_key(self, request):
+        params = [
+            (name, sorted(set(request.query_params.getlist(name))))
+            for name in self.page_cache_params
+            if name in request.query_params
+        ]
+        digest = hashlib.sha256(json.dumps(
+            [request.build_absolute_uri(request.path), params]
+        ).encode()).hexdigest()
+        return 'page:{}:{}:{}'.format(
+            self.page_cache_version,
+            get_version(self.page_cache_version),
+            digest
+        )
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+        cache_key = self.get_page_cache_key(request)
+        data = record_cache_lookup('page', cache.get(cache_key))
+        if data is not None:
+            return Response(data)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(
+                cache_key, response.data, settings.PAGE_CACHE_TIMEOUT
+            )
+        return response
@@ -1,6 +1,40 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 class CustomPagination(PageNumberPagination):
     page_size = 6
     page_size_query_param = 'limit'
+
+
+class CustomCursorPagination(CursorPagination):
+    page_size = 6
+    page_size_query_param = 'limit'
+    ordering = '-id'
+
+
+class FeedPagination(CustomPagination):
+    cursor_pagination_class = CustomCursorPagination
+    pagination_mode_query_param = 'pagination'
+
+    def use_cursor(self, request):
+        return (
+            self.cursor_pagination_class.cursor_query_param
+            in request.query_params
+            or request.query_params.get(
+                self.pagination_mode_query_param
+            ) == 'cursor'
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if self.use_cursor(request):
+            self.cursor_paginator = self.cursor_pagination_class()
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view
+            )
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
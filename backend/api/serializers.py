@@ -1,22 +1,19 @@
-import base64
+from functools import partial
 
-from django.core.files.base import ContentFile
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.validators import UniqueTogetherValidator
 
 from users.serializers import CustomUserSerializer
 from recipes.models import (FavoriteRecipe, Ingredient, Recipe,
-                            RecipeIngredient, ShoppingCard, Tag)
+                            RecipeIngredient, ShoppingCard,
+                            ShoppingCartTotal, Tag)
+from .images import (Base64ImageField, ImageVariantsField,
+                     LimitedImageField)
+from .versions import bump_shopping_cart_versions
 
-
-class Base64ImageField(serializers.ImageField):
-    def to_internal_value(self, data):
-        if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
-        return super().to_internal_value(data)
+MAX_BULK_RECIPES = 100
 
 
 class TagSerializer(serializers.ModelSerializer):
@@ -70,6 +67,7 @@ class RecipeSerializer(serializers.ModelSerializer):
         required=True,
         allow_null=True,
     )
+    image_variants = ImageVariantsField()
     cooking_time = serializers.IntegerField(
         validators=[MinValueValidator(1), MaxValueValidator(999)]
     )
@@ -85,11 +83,17 @@ class RecipeSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_variants',
             'text',
             'cooking_time',
+            'favorites_count',
+            'in_carts_count',
         )
 
-    def _is_related_to_user(self, obj, model):
+    def _is_related_to_user(self, obj, model, annotation):
+        annotated = getattr(obj, annotation, None)
+        if annotated is not None:
+            return annotated
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return model.objects.filter(
@@ -99,10 +103,12 @@ class RecipeSerializer(serializers.ModelSerializer):
         return False
 
     def get_is_favorited(self, obj):
-        return self._is_related_to_user(obj, FavoriteRecipe)
+        return self._is_related_to_user(obj, FavoriteRecipe, 'is_favorited')
 
     def get_is_in_shopping_cart(self, obj):
-        return self._is_related_to_user(obj, ShoppingCard)
+        return self._is_related_to_user(
+            obj, ShoppingCard, 'is_in_shopping_cart'
+        )
 
     def validate_ingredients(self, data):
         ingredients_data = self.initial_data.get('ingredients', [])
@@ -111,30 +117,39 @@ class RecipeSerializer(serializers.ModelSerializer):
                 'ingredients': 'Добавьте хотя бы один ингредиент!'
             })
 
-        ingredient_ids = []
+        ingredients = []
         for ingredient_data in ingredients_data:
-            ingredient_id = ingredient_data.get('id')
-            if ingredient_id in ingredient_ids:
+            if not isinstance(ingredient_data, dict):
                 raise serializers.ValidationError({
-                    'ingredients': 'Ингредиенты должны быть уникальными!'
+                    'ingredients': 'Некорректный формат ингредиента!'
                 })
-            ingredient_ids.append(ingredient_id)
-
-            try:
-                Ingredient.objects.get(pk=ingredient_id)
-            except Ingredient.DoesNotExist:
+            ingredient_id = self._to_int(ingredient_data.get('id'))
+            if ingredient_id is None:
                 raise serializers.ValidationError({
-                    'ingredients': (f'Ингредиент с '
-                                    f'id={ingredient_id} не существует!')
+                    'ingredients': (f'Некорректный id ингредиента: '
+                                    f'{ingredient_data.get("id")}!')
                 })
-            amount = ingredient_data.get('amount', 0)
-            if amount < 1:
+            amount = self._to_int(ingredient_data.get('amount'))
+            if amount is None or amount < 1:
                 raise serializers.ValidationError({
                     'ingredients': ('Значение measurement_unit должно быть '
-                                    'больше или равно 1!')
+                                    'целым числом больше или равным 1!')
                 })
-            ingredient_data['measurement_unit'] = amount
-        return ingredients_data
+            ingredients.append({'id': ingredient_id, 'amount': amount})
+
+        ingredient_ids = [ingredient['id'] for ingredient in ingredients]
+        if len(set(ingredient_ids)) != len(ingredient_ids):
+            raise serializers.ValidationError({
+                'ingredients': 'Ингредиенты должны быть уникальными!'
+            })
+        existing = self._in_bulk(Ingredient, ingredient_ids)
+        for ingredient_id in ingredient_ids:
+            if ingredient_id not in existing:
+                raise serializers.ValidationError({
+                    'ingredients': (f'Ингредиент с '
+                                    f'id={ingredient_id} не существует!')
+                })
+        return ingredients
 
     def validate_tags(self, data):
         tags_data = self.initial_data.get('tags', [])
@@ -143,21 +158,36 @@ class RecipeSerializer(serializers.ModelSerializer):
                 'tags': 'Добавьте хотя бы один тег!'
             })
 
-        tag_ids = []
-        for tag_id in tags_data:
-            if tag_id in tag_ids:
+        tag_ids = [self._to_int(tag_id) for tag_id in tags_data]
+        for tag_id, value in zip(tag_ids, tags_data):
+            if tag_id is None:
                 raise serializers.ValidationError({
-                    'tags': 'Теги должны быть уникальными!'
+                    'tags': f'Некорректный id тега: {value}!'
                 })
-            tag_ids.append(tag_id)
-
-            try:
-                Tag.objects.get(pk=tag_id)
-            except Tag.DoesNotExist:
+        if len(set(tag_ids)) != len(tag_ids):
+            raise serializers.ValidationError({
+                'tags': 'Теги должны быть уникальными!'
+            })
+        existing = self._in_bulk(Tag, tag_ids)
+        for tag_id in tag_ids:
+            if tag_id not in existing:
                 raise serializers.ValidationError({
                     'tags': f'Тег с id={tag_id} не существует!'
                 })
-        return tags_data
+        return tag_ids
+
+    @staticmethod
+    def _to_int(value):
+        try:
+            return serializers.IntegerField().to_internal_value(value)
+        except serializers.ValidationError:
+            return None
+
+    @staticmethod
+    def _in_bulk(model, ids):
+        return set(model.objects.filter(
+            pk__in=ids
+        ).values_list('pk', flat=True))
 
     def validate(self, data):
         ingredients = self.validate_ingredients(data)
@@ -166,63 +196,127 @@ class RecipeSerializer(serializers.ModelSerializer):
         data['tags'] = tags
         return data
 
+    def _write_ingredients(self, recipe, ingredients, existing=()):
+        new_amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in ingredients
+        }
+        existing = {
+            recipe_ingredient.ingredient_id: recipe_ingredient
+            for recipe_ingredient in existing
+        }
+        stale = []
+        changed = []
+        amounts = {}
+        for ingredient_id, recipe_ingredient in existing.items():
+            amount = new_amounts.get(ingredient_id)
+            if amount is None:
+                amounts[ingredient_id] = -recipe_ingredient.amount
+                stale.append(recipe_ingredient.pk)
+            elif amount != recipe_ingredient.amount:
+                amounts[ingredient_id] = amount - recipe_ingredient.amount
+                recipe_ingredient.amount = amount
+                changed.append(recipe_ingredient)
+        if stale:
+            stale = RecipeIngredient.objects.filter(pk__in=stale)
+            stale._raw_delete(stale.db)
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['amount'])
+        created = [
+            RecipeIngredient(
+                recipe=recipe,
+                ingredient_id=ingredient_id,
+                amount=amount
+            )
+            for ingredient_id, amount in new_amounts.items()
+            if ingredient_id not in existing
+        ]
+        RecipeIngredient.objects.bulk_create(created)
+        for recipe_ingredient in created:
+            amounts[recipe_ingredient.ingredient_id] = recipe_ingredient.amount
+        return amounts
+
+    @transaction.atomic
     def create(self, validated_data):
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
         recipe = Recipe.objects.create(**validated_data)
         recipe.tags.set(tags)
-        recipe_ingredients = []
-        ingredient_ids = [ingredient['id'] for ingredient in ingredients]
-        ingredient_objs = Ingredient.objects.in_bulk(ingredient_ids)
-        for ingredient in ingredients:
-            ingredient_obj = ingredient_objs.get(ingredient['id'])
-            if ingredient_obj:
-                recipe_ingredients.append(RecipeIngredient(
-                    recipe=recipe,
-                    amount=ingredient['amount'],
-                    ingredient=ingredient_obj,
-                ))
-
-        RecipeIngredient.objects.bulk_create(recipe_ingredients)
-
+        self._write_ingredients(recipe, ingredients)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         instance.name = validated_data.get('name', instance.name)
         instance.text = validated_data.get('text', instance.text)
         instance.cooking_time = validated_data.get(
             'cooking_time', instance.cooking_time
         )
+        instance.save()
         if 'ingredients' in validated_data:
-            ingredients = self.validate_ingredients(validated_data)
-            RecipeIngredient.objects.filter(recipe=instance).delete()
-            ingredient_ids = [ingredient['id'] for ingredient in ingredients]
-            ingredient_objs = Ingredient.objects.in_bulk(ingredient_ids)
-            for ingredient in ingredients:
-                ingredient_obj = ingredient_objs.get(ingredient['id'])
-                if ingredient_obj:
-                    RecipeIngredient.objects.create(
-                        recipe=instance,
-                        amount=ingredient['amount'],
-                        ingredient=ingredient_obj,
-                    )
+            cart_user_ids = ShoppingCartTotal.objects.change_recipe_amounts(
+                instance.pk,
+                self._write_ingredients(
+                    instance,
+                    validated_data['ingredients'],
+                    instance.recipe_ingredients.all()
+                )
+            )
+            if cart_user_ids:
+                transaction.on_commit(partial(
+                    bump_shopping_cart_versions, cart_user_ids
+                ))
         if 'tags' in validated_data:
-            tags = self.validate_tags(validated_data)
-            instance.tags.clear()
-            for tag_id in tags:
-                tag = Tag.objects.get(pk=tag_id)
-                instance.tags.add(tag)
-
-        instance.save()
+            instance.tags.set(validated_data['tags'])
         return instance
 
 
 class RecipeFavoriteSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = Recipe
         fields = (
             'id',
             'name',
             'image',
+            'image_variants',
             'cooking_time',
         )
+
+
+class RecipeBulkSerializer(serializers.Serializer):
+    add = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        default=list,
+        max_length=MAX_BULK_RECIPES
+    )
+    remove = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        default=list,
+        max_length=MAX_BULK_RECIPES
+    )
+
+    def validate(self, data):
+        data['add'] = list(dict.fromkeys(data['add']))
+        data['remove'] = list(dict.fromkeys(data['remove']))
+        if set(data['add']) & set(data['remove']):
+            raise serializers.ValidationError(
+                'Один рецепт нельзя одновременно добавить и удалить.'
+            )
+        if not data['add'] and not data['remove']:
+            raise serializers.ValidationError(
+                'Передайте рецепты в add или remove.'
+            )
+        return data
+
+
+class RecipeImageSerializer(serializers.ModelSerializer):
+    image = LimitedImageField()
+    image_variants = ImageVariantsField()
+
+    class Meta:
+        model = Recipe
+        fields = ('id', 'image', 'image_variants')
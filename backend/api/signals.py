@@ -0,0 +1,177 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_save)
+from django.dispatch import receiver
+
+from recipes.feed import trim_feed
+from recipes.images import delete_orphaned_image
+from recipes.models import (FavoriteRecipe, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCard, ShoppingCartTotal,
+                            Tag)
+from recipes.tasks import submit_on_commit
+from users.models import CustomUser, Subscribe
+
+from .versions import bump_shopping_cart_versions, bump_version
+
+
+def bump_on_commit(*names):
+    transaction.on_commit(partial(bump_version, *names))
+
+
+def bump_carts_on_commit(user_ids):
+    if user_ids:
+        transaction.on_commit(partial(bump_shopping_cart_versions, user_ids))
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def ingredients_changed(**kwargs):
+    bump_on_commit('ingredients', 'recipes')
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tags_changed(**kwargs):
+    bump_on_commit('tags', 'recipes')
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_contents_changed(**kwargs):
+    bump_on_commit('recipes')
+
+
+AUTHOR_FIELDS = ('email', 'username', 'first_name', 'last_name')
+
+
+@receiver(pre_save, sender=CustomUser)
+def user_saving(instance, raw=False, update_fields=None, **kwargs):
+    instance._author_changed = False
+    if raw or instance._state.adding:
+        return
+    fields = [
+        field for field in AUTHOR_FIELDS
+        if update_fields is None or field in update_fields
+    ]
+    if not fields:
+        return
+    stored = CustomUser.objects.filter(pk=instance.pk).values(*fields).first()
+    instance._author_changed = stored is None or any(
+        stored[field] != getattr(instance, field) for field in fields
+    )
+
+
+@receiver(post_save, sender=CustomUser)
+def user_saved(instance, **kwargs):
+    if instance._author_changed:
+        bump_on_commit('recipes')
+
+
+def change_user_counter(user_id, field, delta):
+    CustomUser.objects.filter(pk=user_id).update(
+        **{field: Greatest(F(field) + delta, 0)}
+    )
+
+
+RECIPE_COUNTERS = {
+    FavoriteRecipe: 'favorites_count',
+    ShoppingCard: 'in_carts_count',
+}
+
+
+@receiver(post_save, sender=FavoriteRecipe)
+@receiver(post_save, sender=ShoppingCard)
+def relation_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Recipe.objects.filter(pk=instance.recipe_id).change_counter(
+            RECIPE_COUNTERS[sender], 1
+        )
+
+
+@receiver(post_delete, sender=FavoriteRecipe)
+@receiver(post_delete, sender=ShoppingCard)
+def relation_deleted(sender, instance, **kwargs):
+    Recipe.objects.filter(pk=instance.recipe_id).change_counter(
+        RECIPE_COUNTERS[sender], -1
+    )
+
+
+@receiver(post_save, sender=ShoppingCard)
+def cart_recipe_added(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ShoppingCartTotal.objects.add_recipes(
+            [instance.user_id], [instance.recipe_id]
+        )
+        bump_carts_on_commit([instance.user_id])
+
+
+@receiver(post_delete, sender=ShoppingCard)
+def cart_recipe_removed(instance, **kwargs):
+    ShoppingCartTotal.objects.remove_recipes(
+        [instance.user_id], [instance.recipe_id]
+    )
+    bump_carts_on_commit([instance.user_id])
+
+
+@receiver(pre_save, sender=RecipeIngredient)
+def recipe_ingredient_saving(instance, raw=False, **kwargs):
+    instance._stored_amount = None
+    if raw or instance._state.adding:
+        return
+    instance._stored_amount = RecipeIngredient.objects.filter(
+        pk=instance.pk
+    ).values_list('ingredient_id', 'amount').first()
+
+
+@receiver(post_save, sender=RecipeIngredient)
+def recipe_ingredient_saved(instance, raw=False, **kwargs):
+    if raw:
+        return
+    amounts = {instance.ingredient_id: instance.amount}
+    if instance._stored_amount is not None:
+        ingredient_id, amount = instance._stored_amount
+        amounts[ingredient_id] = amounts.get(ingredient_id, 0) - amount
+    bump_carts_on_commit(ShoppingCartTotal.objects.change_recipe_amounts(
+        instance.recipe_id, amounts
+    ))
+
+
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_deleted(instance, **kwargs):
+    bump_carts_on_commit(ShoppingCartTotal.objects.change_recipe_amounts(
+        instance.recipe_id, {instance.ingredient_id: -instance.amount}
+    ))
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(instance, created, raw=False, **kwargs):
+    bump_on_commit('recipes')
+    if created and not raw:
+        change_user_counter(instance.author_id, 'recipes_count', 1)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(instance, **kwargs):
+    bump_on_commit('recipes')
+    change_user_counter(instance.author_id, 'recipes_count', -1)
+    if instance.image:
+        submit_on_commit(
+            delete_orphaned_image, instance.image.name, instance.image_variants
+        )
+
+
+@receiver(post_save, sender=Subscribe)
+def subscribe_saved(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_user_counter(instance.subscribed_to_id, 'subscribers_count', 1)
+
+
+@receiver(post_delete, sender=Subscribe)
+def subscribe_deleted(instance, **kwargs):
+    change_user_counter(instance.subscribed_to_id, 'subscribers_count', -1)
+    trim_feed(instance.subscriber_id, instance.subscribed_to_id)
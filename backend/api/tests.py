@@ -1,8 +1,37 @@
 from http import HTTPStatus
 
-from django.test import TestCase
+import base64
+import gzip
+import json
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from prometheus_client import REGISTRY
+from pypdf import PdfReader
 from rest_framework.test import APIClient
 
+from backend.metrics import PrometheusMiddleware
+from backend.middleware import QueryInspectorMiddleware, fingerprint
+from recipes.images import generate_image_variants
+from recipes.models import (FavoriteRecipe, FeedEntry, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCard,
+                            ShoppingCartTotal, Tag, TrendingRecipe)
+from recipes.trending import refresh_trending
+from users.models import CustomUser, Subscribe
+
 
 class CatsAPITestCase(TestCase):
     def setUp(self):
@@ -11,3 +40,1695 @@ class CatsAPITestCase(TestCase):
     def test_list_exists(self):
         response = self.client.get('/api/recipes/')
         self.assertEqual(response.status_code, HTTPStatus.OK)
+
+
+class RecipeUserFlagsTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='cook@example.com', username='cook',
+            first_name='Иван', last_name='Иванов', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.recipes = [
+            Recipe.objects.create(
+                author=self.user,
+                name=f'Рецепт {i}',
+                text='Описание',
+                cooking_time=10
+            )
+            for i in range(3)
+        ]
+
+    def test_flags_are_read_from_annotations(self):
+        FavoriteRecipe.objects.create(recipe=self.recipes[0], user=self.user)
+        ShoppingCard.objects.create(recipe=self.recipes[1], user=self.user)
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        flags = {
+            item['id']: (item['is_favorited'], item['is_in_shopping_cart'])
+            for item in response.data['results']
+        }
+        self.assertEqual(flags[self.recipes[0].id], (True, False))
+        self.assertEqual(flags[self.recipes[1].id], (False, True))
+        self.assertEqual(flags[self.recipes[2].id], (False, False))
+
+    def test_is_favorited_filter(self):
+        FavoriteRecipe.objects.create(recipe=self.recipes[2], user=self.user)
+        response = self.client.get('/api/recipes/', {'is_favorited': 1})
+        self.assertEqual(
+            [item['id'] for item in response.data['results']],
+            [self.recipes[2].id]
+        )
+
+
+class RecipeListQueryCountTestCase(TestCase):
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Пётр', last_name='Петров', password='pass'
+        )
+        self.reader = CustomUser.objects.create_user(
+            email='reader@example.com', username='reader',
+            first_name='Анна', last_name='Сидорова', password='pass'
+        )
+        Subscribe.objects.create(
+            subscriber=self.reader, subscribed_to=self.author
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        self.tag = Tag.objects.create(name='Завтрак', slug='breakfast')
+        self.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {i}', measurement_unit='г'
+            )
+            for i in range(5)
+        ]
+
+    def _create_recipes(self, count, ingredients_per_recipe):
+        for i in range(count):
+            recipe = Recipe.objects.create(
+                author=self.author,
+                name=f'Рецепт {i}',
+                text='Описание',
+                cooking_time=10
+            )
+            recipe.tags.add(self.tag)
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=100)
+                for ingredient in self.ingredients[:ingredients_per_recipe]
+            )
+
+    def _count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        for item in response.data['results']:
+            self.assertTrue(item['author']['is_subscribed'])
+        return len(context.captured_queries)
+
+    def test_query_count_is_constant_per_page(self):
+        self._create_recipes(2, ingredients_per_recipe=1)
+        baseline = self._count_list_queries()
+        Recipe.objects.all().delete()
+        self._create_recipes(6, ingredients_per_recipe=5)
+        self.assertEqual(self._count_list_queries(), baseline)
+
+
+class DownloadShoppingCartTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='buyer@example.com', username='buyer',
+            first_name='Олег', last_name='Олегов', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        salt_grams = Ingredient.objects.create(
+            name='Соль', measurement_unit='г'
+        )
+        salt_pinch = Ingredient.objects.create(
+            name='Соль', measurement_unit='щепотка'
+        )
+        for amount in (5, 10):
+            recipe = Recipe.objects.create(
+                author=self.user,
+                name=f'Рецепт {amount}',
+                text='Описание',
+                cooking_time=10
+            )
+            RecipeIngredient.objects.bulk_create([
+                RecipeIngredient(recipe=recipe, ingredient=salt_grams,
+                                 amount=amount),
+                RecipeIngredient(recipe=recipe, ingredient=salt_pinch,
+                                 amount=1),
+            ])
+            self.client.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+        cache.clear()
+
+    def test_totals_are_grouped_by_name_and_unit(self):
+        response = self.client.get('/api/recipes/download_shopping_cart/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content, 'Соль: 15 г\nСоль: 2 щепотка\n')
+
+    def test_csv_and_ndjson_exports(self):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'csv'}
+        )
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(
+            content.splitlines(),
+            ['name,amount,measurement_unit', 'Соль,15,г', 'Соль,2,щепотка']
+        )
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'json'}
+        )
+        rows = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).splitlines()
+        ]
+        self.assertEqual(
+            rows[0], {'name': 'Соль', 'amount': 15, 'measurement_unit': 'г'}
+        )
+
+    def test_pdf_export_embeds_a_cyrillic_font(self):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'pdf'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        text = ''.join(
+            page.extract_text()
+            for page in PdfReader(BytesIO(response.content)).pages
+        )
+        self.assertIn('Список покупок', text)
+        self.assertIn('Соль', text)
+        self.assertIn('щепотка', text)
+
+    def test_failed_pdf_render_is_not_served_or_cached(self):
+        url = '/api/recipes/download_shopping_cart/'
+        with mock.patch('xhtml2pdf.pisa.CreatePDF') as create_pdf:
+            create_pdf.return_value.err = 1
+            response = self.client.get(url, {'format': 'pdf'})
+        self.assertEqual(
+            response.status_code, HTTPStatus.INTERNAL_SERVER_ERROR
+        )
+        response = self.client.get(url, {'format': 'pdf'})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response.content.startswith(b'%PDF'))
+
+    def test_unknown_format_is_rejected(self):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'xls'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_unchanged_cart_is_served_from_cache(self):
+        url = '/api/recipes/download_shopping_cart/'
+        first = b''.join(self.client.get(url).streaming_content)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.content, first)
+        recipe = Recipe.objects.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/recipes/{recipe.id}/shopping_cart/')
+        self.assertEqual(
+            b''.join(self.client.get(url).streaming_content).decode(),
+            'Соль: 5 г\nСоль: 1 щепотка\n'
+        )
+
+    def test_editing_a_carted_recipe_updates_totals(self):
+        recipe = Recipe.objects.first()
+        salt = Ingredient.objects.get(measurement_unit='г')
+        tag = Tag.objects.create(name='Обед', slug='lunch')
+        author = APIClient()
+        author.force_authenticate(self.user)
+        response = author.patch(f'/api/recipes/{recipe.id}/', {
+            'ingredients': [{'id': salt.id, 'amount': 100}],
+            'tags': [tag.id],
+            'name': recipe.name,
+            'text': recipe.text,
+            'cooking_time': recipe.cooking_time,
+            'image': None,
+        }, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        content = b''.join(self.client.get(
+            '/api/recipes/download_shopping_cart/'
+        ).streaming_content).decode()
+        self.assertEqual(content, 'Соль: 105 г\nСоль: 1 щепотка\n')
+        out = StringIO()
+        call_command('reconcile_shopping_cart', '--dry-run', stdout=out)
+        self.assertIn(
+            'Missing rows: 0, extra rows: 0, mismatched totals: 0',
+            out.getvalue()
+        )
+
+    def _totals(self):
+        return dict(ShoppingCartTotal.objects.filter(
+            user=self.user
+        ).values_list('ingredient__measurement_unit', 'total_amount'))
+
+    def test_orm_writes_keep_totals_in_sync(self):
+        chef = CustomUser.objects.create_user(
+            email='chef@example.com', username='chef',
+            first_name='Шеф', last_name='Шефов', password='pass'
+        )
+        pepper = Ingredient.objects.create(name='Перец', measurement_unit='шт')
+        recipe = Recipe.objects.create(
+            author=chef, name='Рецепт шефа', text='Описание', cooking_time=5
+        )
+        RecipeIngredient.objects.create(
+            recipe=recipe, ingredient=pepper, amount=3
+        )
+        ShoppingCard.objects.create(recipe=recipe, user=self.user)
+        self.assertEqual(self._totals(), {'г': 15, 'щепотка': 2, 'шт': 3})
+        salt = RecipeIngredient.objects.get(
+            recipe__name='Рецепт 5', ingredient__measurement_unit='г'
+        )
+        salt.amount = 7
+        salt.save()
+        RecipeIngredient.objects.filter(
+            recipe__name='Рецепт 10', ingredient__measurement_unit='щепотка'
+        ).delete()
+        self.assertEqual(self._totals(), {'г': 17, 'щепотка': 1, 'шт': 3})
+        chef.delete()
+        self.assertEqual(self._totals(), {'г': 17, 'щепотка': 1})
+        ShoppingCard.objects.filter(recipe__name='Рецепт 10').delete()
+        self.assertEqual(self._totals(), {'г': 7, 'щепотка': 1})
+        Recipe.objects.all().delete()
+        self.assertEqual(self._totals(), {})
+
+
+class IngredientAutocompleteTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        cache.clear()
+        for name in ('Мёд', 'Мед гречишный', 'Молоко', 'Масло'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def _names(self, **params):
+        response = self.client.get('/api/ingredients/', params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [item['name'] for item in response.data]
+
+    def test_prefix_search_folds_case_and_yo(self):
+        self.assertEqual(self._names(name='МЕД'), ['Мёд', 'Мед гречишный'])
+        self.assertEqual(self._names(name='мё'), ['Мёд', 'Мед гречишный'])
+        self.assertEqual(self._names(name='мо', limit=1), ['Молоко'])
+        with self.assertNumQueries(0):
+            self._names(name='м')
+
+    def test_index_is_rebuilt_after_changes(self):
+        self.assertEqual(self._names(name='сыр'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(name='Сыр', measurement_unit='г')
+        self.assertEqual(self._names(name='сыр'), ['Сыр'])
+
+
+class CursorPaginationTestCase(TestCase):
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(
+            email='chef@example.com', username='chef',
+            first_name='Мария', last_name='Кузнецова', password='pass'
+        )
+        self.client = APIClient()
+        self.recipe_ids = [
+            Recipe.objects.create(
+                author=self.author,
+                name=f'Рецепт {i}',
+                text='Описание',
+                cooking_time=10
+            ).id
+            for i in range(5)
+        ]
+
+    def test_cursor_mode_walks_the_feed_without_counting(self):
+        response = self.client.get(
+            '/api/recipes/', {'pagination': 'cursor', 'limit': 3}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertNotIn('count', response.data)
+        first_page = [item['id'] for item in response.data['results']]
+        self.assertEqual(first_page, sorted(self.recipe_ids)[:-4:-1])
+        response = self.client.get(response.data['next'])
+        second_page = [item['id'] for item in response.data['results']]
+        self.assertEqual(second_page, sorted(self.recipe_ids)[1::-1])
+        self.assertIsNone(response.data['next'])
+        self.assertIsNotNone(response.data['previous'])
+
+    def test_page_number_mode_is_the_default(self):
+        response = self.client.get('/api/recipes/', {'page': 2, 'limit': 3})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_subscriptions_list_supports_cursor_mode(self):
+        reader = CustomUser.objects.create_user(
+            email='fan@example.com', username='fan',
+            first_name='Фан', last_name='Фанов', password='pass'
+        )
+        Subscribe.objects.create(subscriber=reader, subscribed_to=self.author)
+        self.client.force_authenticate(reader)
+        response = self.client.get(
+            '/api/users/subscriptions/', {'pagination': 'cursor'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(
+            [item['id'] for item in response.data['results']],
+            [self.author.id]
+        )
+
+
+class CatalogCacheTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        cache.clear()
+        Tag.objects.create(name='Ужин', slug='dinner')
+
+    def test_catalog_is_compressed_and_revalidated(self):
+        response = self.client.get('/api/tags/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            json.loads(gzip.decompress(response.content))[0]['slug'],
+            'dinner'
+        )
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                '/api/tags/',
+                HTTP_ACCEPT_ENCODING='gzip',
+                HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+    def test_catalog_changes_invalidate_the_etag(self):
+        etag = self.client.get('/api/tags/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Обед', slug='lunch')
+        response = self.client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(json.loads(response.content)), 2)
+
+    @override_settings(VERSION_STAMP_TIMEOUT=30)
+    def test_local_cache_entries_expire(self):
+        etag = self.client.get('/api/tags/')['ETag']
+        Tag.objects.update(name='Завтрак')
+        response = self.client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        with mock.patch('time.time', return_value=time.time() + 31):
+            response = self.client.get(
+                '/api/tags/', HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(json.loads(response.content)[0]['name'], 'Завтрак')
+
+    @override_settings(VERSION_STAMP_TIMEOUT=30)
+    def test_expired_stamp_keeps_the_etag_of_unchanged_content(self):
+        etag = self.client.get(
+            '/api/tags/', HTTP_ACCEPT_ENCODING='br'
+        )['ETag']
+        compress = mock.Mock(return_value=b'')
+        with mock.patch('time.time', return_value=time.time() + 31):
+            with mock.patch('api.catalog.ENCODINGS', (('br', compress),)):
+                response = self.client.get(
+                    '/api/tags/', HTTP_ACCEPT_ENCODING='br'
+                )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['ETag'], etag)
+        compress.assert_not_called()
+
+
+class SubscriptionsListTestCase(TestCase):
+    def setUp(self):
+        self.reader = CustomUser.objects.create_user(
+            email='follower@example.com', username='follower',
+            first_name='Павел', last_name='Павлов', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        self.authors = []
+        for i in range(3):
+            author = CustomUser.objects.create_user(
+                email=f'writer{i}@example.com', username=f'writer{i}',
+                first_name='Автор', last_name=f'№{i}', password='pass'
+            )
+            for j in range(i + 1):
+                Recipe.objects.create(
+                    author=author,
+                    name=f'Рецепт {i}.{j}',
+                    text='Описание',
+                    cooking_time=10
+                )
+            Subscribe.objects.create(subscriber=self.reader,
+                                     subscribed_to=author)
+            self.authors.append(author)
+
+    def test_subscriptions_are_annotated(self):
+        response = self.client.get('/api/users/subscriptions/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.data['count'], 3)
+        counts = {
+            item['id']: item['recipes_count']
+            for item in response.data['results']
+        }
+        self.assertEqual(
+            counts, {author.id: i + 1 for i, author in enumerate(self.authors)}
+        )
+        self.assertTrue(all(
+            item['is_subscribed'] for item in response.data['results']
+        ))
+
+    def test_recipe_previews_are_limited_per_author(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                '/api/users/subscriptions/', {'recipes_limit': 2}
+            )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        previews = {
+            item['id']: len(item['recipes'])
+            for item in response.data['results']
+        }
+        self.assertEqual(
+            previews, {author.id: min(i + 1, 2)
+                       for i, author in enumerate(self.authors)}
+        )
+        for i in range(3, 6):
+            author = CustomUser.objects.create_user(
+                email=f'writer{i}@example.com', username=f'writer{i}',
+                first_name='Автор', last_name=f'№{i}', password='pass'
+            )
+            Subscribe.objects.create(subscriber=self.reader,
+                                     subscribed_to=author)
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.client.get('/api/users/subscriptions/', {'recipes_limit': 2})
+
+    def test_invalid_recipes_limit_is_rejected(self):
+        response = self.client.get(
+            '/api/users/subscriptions/', {'recipes_limit': 'abc'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
+class RecipeWriteTestCase(TestCase):
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(
+            email='baker@example.com', username='baker',
+            first_name='Игорь', last_name='Игорев', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.author)
+        self.tags = [
+            Tag.objects.create(name=f'Тег {i}', slug=f'tag-{i}')
+            for i in range(3)
+        ]
+        self.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {i}', measurement_unit='г'
+            )
+            for i in range(25)
+        ]
+
+    def _payload(self, ingredients, tags):
+        return {
+            'ingredients': [
+                {'id': ingredient.id, 'amount': amount}
+                for ingredient, amount in ingredients
+            ],
+            'tags': [tag.id for tag in tags],
+            'name': 'Пирог',
+            'text': 'Описание',
+            'cooking_time': 30,
+            'image': None,
+        }
+
+    def test_patch_applies_ingredient_diff_in_a_handful_of_queries(self):
+        response = self.client.post('/api/recipes/', self._payload(
+            [(ingredient, 10) for ingredient in self.ingredients[:20]],
+            self.tags[:2]
+        ), format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        recipe_id = response.data['id']
+        payload = self._payload(
+            [(ingredient, 20) for ingredient in self.ingredients[:10]]
+            + [(ingredient, 10) for ingredient in self.ingredients[10:15]]
+            + [(ingredient, 5) for ingredient in self.ingredients[20:]],
+            self.tags[1:]
+        )
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                f'/api/recipes/{recipe_id}/', payload, format='json'
+            )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertLess(len(context.captured_queries), 25)
+        self.assertEqual(
+            dict(RecipeIngredient.objects.filter(
+                recipe_id=recipe_id
+            ).values_list('ingredient_id', 'amount')),
+            {item['id']: item['amount'] for item in payload['ingredients']}
+        )
+        self.assertEqual(
+            sorted(tag['id'] for tag in response.data['tags']),
+            [tag.id for tag in self.tags[1:]]
+        )
+
+    def test_unknown_ingredient_is_rejected(self):
+        payload = self._payload([(self.ingredients[0], 1)], self.tags[:1])
+        payload['ingredients'].append({'id': 100500, 'amount': 1})
+        response = self.client.post('/api/recipes/', payload, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_malformed_ingredients_and_tags_are_rejected(self):
+        ingredient = self.ingredients[0].id
+        for ingredients, tags in (
+            ([{'id': [ingredient], 'amount': 2}], None),
+            ([{'id': {'id': ingredient}, 'amount': 2}], None),
+            ([{'id': ingredient, 'amount': 2.7}], None),
+            ([{'id': ingredient, 'amount': True}], None),
+            ([{'id': ingredient, 'amount': [2]}], None),
+            ([[ingredient, 2]], None),
+            (None, [[self.tags[0].id]]),
+            (None, [{'id': self.tags[0].id}]),
+        ):
+            with self.subTest(ingredients=ingredients, tags=tags):
+                payload = self._payload([(self.ingredients[0], 1)], [])
+                payload['tags'] = tags or [self.tags[0].id]
+                if ingredients is not None:
+                    payload['ingredients'] = ingredients
+                response = self.client.post(
+                    '/api/recipes/', payload, format='json'
+                )
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST
+                )
+        payload = self._payload([(self.ingredients[0], 1)], self.tags[:1])
+        payload['ingredients'][0]['amount'] = 3.0
+        response = self.client.post('/api/recipes/', payload, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.data['ingredients'][0]['amount'], 3)
+
+
+class RecipeRelationToggleTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='fan@example.com', username='fan',
+            first_name='Ольга', last_name='Ольгина', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        ingredient = Ingredient.objects.create(
+            name='Мука', measurement_unit='г'
+        )
+        self.recipe = Recipe.objects.create(
+            author=self.user, name='Блины', text='Описание', cooking_time=20
+        )
+        RecipeIngredient.objects.create(
+            recipe=self.recipe, ingredient=ingredient, amount=200
+        )
+
+    def test_status_codes(self):
+        for url in ('favorite', 'shopping_cart'):
+            with self.subTest(url=url):
+                path = f'/api/recipes/{self.recipe.id}/{url}/'
+                response = self.client.post(path)
+                self.assertEqual(response.status_code, HTTPStatus.CREATED)
+                self.assertEqual(response.data['name'], 'Блины')
+                response = self.client.post(path)
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST
+                )
+                response = self.client.delete(path)
+                self.assertEqual(
+                    response.status_code, HTTPStatus.NO_CONTENT
+                )
+                response = self.client.delete(path)
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST
+                )
+                missing = f'/api/recipes/100500/{url}/'
+                response = self.client.post(missing)
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST
+                )
+                response = self.client.delete(missing)
+                self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+        self.assertFalse(FavoriteRecipe.objects.exists())
+        self.assertFalse(ShoppingCartTotal.objects.exists())
+
+    def test_favorite_toggle_does_not_lock_the_user(self):
+        path = f'/api/recipes/{self.recipe.id}/favorite/'
+        with CaptureQueriesContext(connection) as context:
+            self.client.post(path)
+        statements = [
+            query['sql'] for query in context.captured_queries
+            if 'SAVEPOINT' not in query['sql']
+        ]
+        self.assertEqual(
+            [statement.split()[0] for statement in statements],
+            ['SELECT', 'INSERT', 'UPDATE']
+        )
+        self.assertNotIn('users_customuser', statements[0])
+        with CaptureQueriesContext(connection) as context:
+            self.client.delete(path)
+        statements = [
+            query['sql'] for query in context.captured_queries
+            if 'SAVEPOINT' not in query['sql']
+        ]
+        self.assertEqual(
+            [statement.split()[0] for statement in statements],
+            ['SELECT', 'SELECT', 'DELETE', 'UPDATE']
+        )
+        self.assertNotIn('users_customuser', ' '.join(statements))
+
+
+class RecipeBulkRelationTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='sync@example.com', username='sync',
+            first_name='Антон', last_name='Антонов', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        ingredient = Ingredient.objects.create(
+            name='Сахар', measurement_unit='г'
+        )
+        self.recipes = []
+        for index in range(4):
+            recipe = Recipe.objects.create(
+                author=self.user, name=f'Десерт {index}',
+                text='Описание', cooking_time=15
+            )
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=10
+            )
+            self.recipes.append(recipe)
+
+    def test_bulk_shopping_cart_reports_per_id_outcomes(self):
+        first, second, third, _ = self.recipes
+        self.client.post(f'/api/recipes/{first.id}/shopping_cart/')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(
+                '/api/recipes/shopping_cart/bulk/',
+                {
+                    'add': [first.id, second.id, 100500],
+                    'remove': [third.id],
+                },
+                format='json'
+            )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertLess(len(context.captured_queries), 14)
+        self.assertEqual(
+            [
+                (item['id'], item['status'])
+                for item in response.data['results']
+            ],
+            [
+                (first.id, 'already_added'),
+                (second.id, 'added'),
+                (100500, 'not_found'),
+                (third.id, 'not_added'),
+            ]
+        )
+        self.assertEqual(
+            ShoppingCartTotal.objects.get(user=self.user).total_amount, 20
+        )
+        response = self.client.post(
+            '/api/recipes/shopping_cart/bulk/',
+            {'remove': [first.id]},
+            format='json'
+        )
+        self.assertEqual(response.data['results'][0]['status'], 'removed')
+        self.assertEqual(
+            ShoppingCartTotal.objects.get(user=self.user).total_amount, 10
+        )
+        response = self.client.delete('/api/recipes/shopping_cart/')
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.assertFalse(ShoppingCard.objects.filter(user=self.user).exists())
+        self.assertFalse(
+            ShoppingCartTotal.objects.filter(user=self.user).exists()
+        )
+
+    def test_replayed_batch_is_applied_once(self):
+        ids = [recipe.id for recipe in self.recipes[:2]]
+        for expected in ('added', 'already_added'):
+            response = self.client.post(
+                '/api/recipes/shopping_cart/bulk/', {'add': ids},
+                format='json'
+            )
+            self.assertEqual(
+                {item['status'] for item in response.data['results']},
+                {expected}
+            )
+        self.assertEqual(
+            ShoppingCartTotal.objects.get(user=self.user).total_amount, 20
+        )
+        self.assertEqual(
+            list(Recipe.objects.filter(pk__in=ids).values_list(
+                'in_carts_count', flat=True
+            )),
+            [1, 1]
+        )
+        for expected in ('removed', 'not_added'):
+            response = self.client.post(
+                '/api/recipes/shopping_cart/bulk/', {'remove': ids},
+                format='json'
+            )
+            self.assertEqual(
+                {item['status'] for item in response.data['results']},
+                {expected}
+            )
+        self.assertFalse(ShoppingCartTotal.objects.exists())
+        self.assertEqual(
+            list(Recipe.objects.filter(pk__in=ids).values_list(
+                'in_carts_count', flat=True
+            )),
+            [0, 0]
+        )
+
+    def test_bulk_favorites(self):
+        ids = [recipe.id for recipe in self.recipes]
+        response = self.client.post(
+            '/api/recipes/favorite/bulk/', {'add': ids}, format='json'
+        )
+        self.assertEqual(
+            {item['status'] for item in response.data['results']}, {'added'}
+        )
+        self.assertEqual(
+            FavoriteRecipe.objects.filter(user=self.user).count(), 4
+        )
+
+    def test_conflicting_payload_is_rejected(self):
+        recipe_id = self.recipes[0].id
+        for payload in (
+            {'add': [recipe_id], 'remove': [recipe_id]},
+            {},
+            {'add': ['abc']},
+            {'add': list(range(1, 200))},
+        ):
+            with self.subTest(payload=payload):
+                response = self.client.post(
+                    '/api/recipes/favorite/bulk/', payload, format='json'
+                )
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST
+                )
+
+
+def make_image(image_format='PNG', size=(40, 30)):
+    buffer = BytesIO()
+    Image.new('RGB', size, (200, 80, 40)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class RecipeImageUploadTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.author = CustomUser.objects.create_user(
+            email='painter@example.com', username='painter',
+            first_name='Илья', last_name='Репин', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.author)
+        self.recipe = Recipe.objects.create(
+            author=self.author, name='Борщ', text='Описание', cooking_time=90
+        )
+        self.url = f'/api/recipes/{self.recipe.id}/image/'
+
+    def _upload(self, content, name='dish.png'):
+        return self.client.put(
+            self.url,
+            {'image': SimpleUploadedFile(name, content)},
+            format='multipart'
+        )
+
+    def test_multipart_upload(self):
+        response = self._upload(make_image())
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.recipe.refresh_from_db()
+        self.assertTrue(self.recipe.image.name.startswith('uploads/'))
+        self.assertEqual(self.recipe.image.width, 40)
+
+    def test_limits(self):
+        with override_settings(RECIPE_IMAGE_MAX_SIZE=100):
+            response = self._upload(make_image(size=(400, 400)))
+        self.assertEqual(
+            response.status_code, HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        )
+        with override_settings(RECIPE_IMAGE_MAX_SIDE=32):
+            response = self._upload(make_image())
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self._upload(make_image('BMP'), name='dish.bmp')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self._upload(b'not an image')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_malformed_or_missing_content_length(self):
+        for content_length, expected in (
+            ('abc', HTTPStatus.BAD_REQUEST),
+            ('', HTTPStatus.LENGTH_REQUIRED),
+        ):
+            with self.subTest(content_length=content_length):
+                response = self.client.put(
+                    self.url,
+                    {'image': SimpleUploadedFile('dish.png', make_image())},
+                    format='multipart',
+                    CONTENT_LENGTH=content_length
+                )
+                self.assertEqual(response.status_code, expected)
+
+    def test_generated_variants_reach_anonymous_pages(self):
+        cache.clear()
+        self._upload(make_image(size=(400, 300)))
+        url = f'/api/recipes/{self.recipe.id}/'
+        anonymous = APIClient()
+        self.assertIsNone(anonymous.get(url).data['image_variants'])
+        with self.captureOnCommitCallbacks(execute=True):
+            generate_image_variants(self.recipe.id)
+        self.assertIsNotNone(anonymous.get(url).data['image_variants'])
+
+    @override_settings(BACKGROUND_TASKS_SYNC=True)
+    def test_upload_generates_variants_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self._upload(make_image(size=(800, 600)))
+        self.assertIsNone(response.data['image_variants'])
+        response = self.client.get(f'/api/recipes/{self.recipe.id}/')
+        variants = response.data['image_variants']
+        self.assertTrue(
+            variants['placeholder'].startswith('data:image/webp;base64,')
+        )
+        self.assertEqual(
+            [
+                source.rsplit(' ', 1)[1]
+                for source in variants['srcset']['webp'].split(', ')
+            ],
+            ['800w', '640w', '320w', '160w']
+        )
+        self.assertIn('jpeg', variants['srcset'])
+        self.recipe.refresh_from_db()
+        for source in self.recipe.image_variants['sources']:
+            with self.recipe.image.storage.open(source['name']) as file:
+                with Image.open(file) as image:
+                    self.assertEqual(image.width, source['width'])
+
+    @override_settings(BACKGROUND_TASKS_SYNC=True)
+    def test_identical_uploads_share_one_file_until_orphaned(self):
+        other = Recipe.objects.create(
+            author=self.author, name='Щи', text='Описание', cooking_time=60
+        )
+        content = make_image(size=(400, 300))
+        with self.captureOnCommitCallbacks(execute=True):
+            self._upload(content)
+            self.client.put(
+                f'/api/recipes/{other.id}/image/',
+                {'image': SimpleUploadedFile('copy.png', content)},
+                format='multipart'
+            )
+        self.recipe.refresh_from_db()
+        other.refresh_from_db()
+        name = self.recipe.image.name
+        self.assertEqual(name, other.image.name)
+        self.assertRegex(name, r'^uploads/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        storage = self.recipe.image.storage
+        variants = [
+            source['name'] for source in other.image_variants['sources']
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/recipes/{self.recipe.id}/')
+        self.assertTrue(storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f'/api/recipes/{other.id}/image/',
+                {'image': SimpleUploadedFile('new.png', make_image())},
+                format='multipart'
+            )
+        self.assertFalse(storage.exists(name))
+        for variant in variants:
+            self.assertFalse(storage.exists(variant))
+        other.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertFalse(storage.exists(other.image.name))
+
+    @override_settings(BACKGROUND_TASKS_SYNC=True)
+    def test_admin_image_replacement_cleans_up_old_files(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._upload(make_image(size=(400, 300)))
+        self.recipe.refresh_from_db()
+        storage = self.recipe.image.storage
+        old_files = [self.recipe.image.name] + [
+            source['name'] for source in self.recipe.image_variants['sources']
+        ]
+        admin = CustomUser.objects.create_user(
+            email='root@example.com', username='root',
+            first_name='Админ', last_name='Админов', password='pass',
+            is_staff=True, is_superuser=True
+        )
+        tag = Tag.objects.create(name='Суп', slug='soup')
+        self.client.force_login(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'/admin/recipes/recipe/{self.recipe.id}/change/',
+                {
+                    'author': self.author.id,
+                    'name': 'Борщ',
+                    'text': 'Описание',
+                    'cooking_time': 90,
+                    'tags': [tag.id],
+                    'image': SimpleUploadedFile('new.png', make_image()),
+                }
+            )
+        self.assertEqual(response.status_code, HTTPStatus.FOUND)
+        for name in old_files:
+            self.assertFalse(storage.exists(name))
+        self.recipe.refresh_from_db()
+        self.assertNotEqual(self.recipe.image.name, old_files[0])
+        self.assertTrue(storage.exists(self.recipe.image.name))
+        self.assertEqual(
+            {
+                source['width']
+                for source in self.recipe.image_variants['sources']
+            },
+            {40}
+        )
+
+    def test_only_author_can_upload(self):
+        stranger = CustomUser.objects.create_user(
+            email='stranger@example.com', username='stranger',
+            first_name='Пётр', last_name='Петров', password='pass'
+        )
+        self.client.force_authenticate(stranger)
+        response = self._upload(make_image())
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    def test_base64_field_applies_the_same_limits(self):
+        ingredient = Ingredient.objects.create(
+            name='Свёкла', measurement_unit='г'
+        )
+        tag = Tag.objects.create(name='Суп', slug='soup')
+        payload = {
+            'ingredients': [{'id': ingredient.id, 'amount': 300}],
+            'tags': [tag.id],
+            'name': 'Борщ',
+            'text': 'Описание',
+            'cooking_time': 90,
+            'image': 'data:image/png;base64,' + base64.b64encode(
+                make_image(size=(64, 64))
+            ).decode(),
+        }
+        with override_settings(RECIPE_IMAGE_MAX_SIDE=32):
+            response = self.client.post(
+                '/api/recipes/', payload, format='json'
+            )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self.client.post('/api/recipes/', payload, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+
+
+class AdminChangelistQueryCountTestCase(TestCase):
+    changelists = (
+        '/admin/recipes/recipe/',
+        '/admin/recipes/recipeingredient/',
+        '/admin/recipes/favoriterecipe/',
+        '/admin/recipes/shoppingcard/',
+        '/admin/recipes/ingredient/',
+        '/admin/users/subscribe/',
+    )
+
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user(
+            email='admin@example.com', username='admin',
+            first_name='Админ', last_name='Админов', password='pass',
+            is_staff=True, is_superuser=True
+        )
+        self.client.force_login(self.admin)
+        self.ingredient = Ingredient.objects.create(
+            name='Молоко', measurement_unit='мл'
+        )
+
+    def _add_rows(self, count):
+        for _ in range(count):
+            index = CustomUser.objects.count()
+            user = CustomUser.objects.create_user(
+                email=f'cook{index}@example.com', username=f'cook{index}',
+                first_name='Повар', last_name='Поваров', password='pass'
+            )
+            recipe = Recipe.objects.create(
+                author=user, name=f'Каша {index}',
+                text='Описание', cooking_time=10
+            )
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=self.ingredient, amount=100
+            )
+            FavoriteRecipe.objects.create(recipe=recipe, user=self.admin)
+            ShoppingCard.objects.create(recipe=recipe, user=self.admin)
+            Subscribe.objects.create(subscriber=self.admin, subscribed_to=user)
+
+    def _count_queries(self):
+        counts = {}
+        for url in self.changelists:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            counts[url] = len(context.captured_queries)
+        return counts
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self._add_rows(2)
+        few = self._count_queries()
+        self._add_rows(8)
+        self.assertEqual(self._count_queries(), few)
+
+    def test_recipe_changelist_shows_favorite_counts(self):
+        self._add_rows(1)
+        response = self.client.get('/admin/recipes/recipe/')
+        self.assertEqual(
+            response.context['cl'].result_list[0].favorites_count, 1
+        )
+        response = self.client.get(
+            '/admin/recipes/ingredient/', {'q': 'олок'}
+        )
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class PopularityCountersTestCase(TestCase):
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(
+            email='chef@example.com', username='chef',
+            first_name='Шеф', last_name='Поваров', password='pass'
+        )
+        self.reader = CustomUser.objects.create_user(
+            email='guest@example.com', username='guest',
+            first_name='Гость', last_name='Гостев', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        self.recipes = [
+            Recipe.objects.create(
+                author=self.author, name=f'Суп {index}',
+                text='Описание', cooking_time=30
+            )
+            for index in range(3)
+        ]
+
+    def _recipe_counters(self):
+        return list(Recipe.objects.order_by('id').values_list(
+            'favorites_count', 'in_carts_count'
+        ))
+
+    def test_counters_follow_writes(self):
+        first, second, third = self.recipes
+        self.client.post(f'/api/recipes/{first.id}/favorite/')
+        self.client.post(
+            '/api/recipes/favorite/bulk/',
+            {'add': [second.id, third.id]},
+            format='json'
+        )
+        self.client.delete(f'/api/recipes/{third.id}/favorite/')
+        self.client.post(f'/api/recipes/{first.id}/shopping_cart/')
+        self.client.post(f'/api/recipes/{second.id}/shopping_cart/')
+        self.assertEqual(
+            self._recipe_counters(), [(1, 1), (1, 1), (0, 0)]
+        )
+        self.client.delete('/api/recipes/shopping_cart/')
+        self.assertEqual(
+            self._recipe_counters(), [(1, 0), (1, 0), (0, 0)]
+        )
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.recipes_count, 3)
+        self.assertEqual(self.author.subscribers_count, 1)
+        response = self.client.get('/api/users/subscriptions/')
+        self.assertEqual(response.data['results'][0]['recipes_count'], 3)
+        self.client.delete(f'/api/users/{self.author.id}/subscribe/')
+        third.delete()
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.recipes_count, 2)
+        self.assertEqual(self.author.subscribers_count, 0)
+
+    def test_orm_writes_keep_counters_and_never_go_negative(self):
+        first = self.recipes[0]
+        FavoriteRecipe.objects.create(recipe=first, user=self.reader)
+        ShoppingCard.objects.create(recipe=first, user=self.reader)
+        self.assertEqual(self._recipe_counters()[0], (1, 1))
+        Recipe.objects.filter(pk=first.pk).update(favorites_count=0)
+        response = self.client.delete(f'/api/recipes/{first.id}/favorite/')
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.assertEqual(self._recipe_counters()[0], (0, 1))
+        self.reader.delete()
+        self.assertEqual(self._recipe_counters()[0], (0, 0))
+
+    def test_ordering_by_counter(self):
+        FavoriteRecipe.objects.create(recipe=self.recipes[0], user=self.reader)
+        response = self.client.get(
+            '/api/recipes/', {'ordering': '-favorites_count'}
+        )
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [self.recipes[0].id, self.recipes[2].id, self.recipes[1].id]
+        )
+        self.assertEqual(response.data['results'][0]['favorites_count'], 1)
+        response = self.client.get('/api/recipes/', {'ordering': 'name'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_reconcile_counters_repairs_drift(self):
+        FavoriteRecipe.objects.create(recipe=self.recipes[1], user=self.reader)
+        Recipe.objects.filter(pk=self.recipes[1].pk).update(favorites_count=5)
+        CustomUser.objects.filter(pk=self.author.pk).update(recipes_count=7)
+        out = StringIO()
+        call_command('reconcile_counters', '--batch-size=2', stdout=out)
+        self.assertIn(
+            'recipe.favorites_count: drifted rows: 1', out.getvalue()
+        )
+        self.assertIn(
+            'customuser.recipes_count: drifted rows: 1', out.getvalue()
+        )
+        self.assertEqual(
+            self._recipe_counters(), [(0, 0), (1, 0), (0, 0)]
+        )
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.recipes_count, 3)
+
+
+@override_settings(TRENDING_COMMIT_LAG_SECONDS=0)
+class TrendingRecipesTestCase(TestCase):
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(
+            email='trend@example.com', username='trend',
+            first_name='Мария', last_name='Маринина', password='pass'
+        )
+        self.fans = [
+            CustomUser.objects.create_user(
+                email=f'fan{index}@example.com', username=f'fan{index}',
+                first_name='Фан', last_name='Фанов', password='pass'
+            )
+            for index in range(3)
+        ]
+        self.tag = Tag.objects.create(name='Выпечка', slug='bakery')
+        self.recipes = [
+            Recipe.objects.create(
+                author=self.author, name=f'Пирог {index}',
+                text='Описание', cooking_time=40
+            )
+            for index in range(3)
+        ]
+        self.recipes[1].tags.add(self.tag)
+        self.now = timezone.now()
+
+    def _favorite(self, recipe, fans, age):
+        for fan in fans:
+            FavoriteRecipe.objects.create(
+                recipe=recipe, user=fan, created=self.now - age
+            )
+
+    def _trending_ids(self, **params):
+        response = self.client.get('/api/recipes/trending/', params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_recent_activity_outranks_older_activity(self):
+        old, fresh, idle = self.recipes
+        self._favorite(old, self.fans, timedelta(days=10))
+        self._favorite(fresh, self.fans[:1], timedelta(hours=1))
+        self.assertEqual(refresh_trending(now=self.now), 2)
+        self.assertEqual(self._trending_ids(), [fresh.id, old.id])
+        self.assertEqual(self._trending_ids(tags='bakery'), [fresh.id])
+
+    def test_incremental_refresh_only_touches_new_activity(self):
+        first, second, _ = self.recipes
+        self._favorite(first, self.fans[:2], timedelta(hours=2))
+        refresh_trending(now=self.now)
+        score = TrendingRecipe.objects.get(recipe=first).score
+        ShoppingCard.objects.create(
+            recipe=second, user=self.fans[0],
+            created=self.now + timedelta(seconds=30)
+        )
+        self.assertEqual(
+            refresh_trending(now=self.now + timedelta(minutes=1)), 1
+        )
+        self.assertEqual(TrendingRecipe.objects.get(recipe=first).score, score)
+        self._favorite(first, self.fans[2:], timedelta(seconds=-90))
+        refresh_trending(now=self.now + timedelta(minutes=2))
+        incremental = TrendingRecipe.objects.get(recipe=first).score
+        self.assertGreater(incremental, score)
+        refresh_trending(full=True, now=self.now + timedelta(minutes=2))
+        self.assertAlmostEqual(
+            TrendingRecipe.objects.get(recipe=first).score, incremental
+        )
+
+    def test_overlapping_refresh_is_skipped(self):
+        self._favorite(self.recipes[0], self.fans, timedelta(hours=1))
+        with mock.patch('recipes.trending.try_lock_name', return_value=False):
+            self.assertIsNone(refresh_trending(now=self.now))
+        self.assertFalse(TrendingRecipe.objects.exists())
+        self.assertEqual(refresh_trending(now=self.now), 1)
+
+
+@override_settings(BACKGROUND_TASKS_SYNC=True, FEED_FANOUT_BATCH_SIZE=2)
+class FollowFeedTestCase(TestCase):
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(
+            email='writer@example.com', username='writer',
+            first_name='Лев', last_name='Толстой', password='pass'
+        )
+        self.other = CustomUser.objects.create_user(
+            email='other@example.com', username='other',
+            first_name='Иван', last_name='Тургенев', password='pass'
+        )
+        self.followers = [
+            CustomUser.objects.create_user(
+                email=f'reader{index}@example.com',
+                username=f'reader{index}',
+                first_name='Читатель', last_name='Читателев', password='pass'
+            )
+            for index in range(3)
+        ]
+        self.old_recipes = [
+            Recipe.objects.create(
+                author=author, name=f'Старый рецепт {index}',
+                text='Описание', cooking_time=10
+            )
+            for index, author in enumerate(
+                (self.author, self.other, self.author)
+            )
+        ]
+        self.client = APIClient()
+        self.ingredient = Ingredient.objects.create(
+            name='Яйцо', measurement_unit='шт'
+        )
+        self.tag = Tag.objects.create(name='Завтрак', slug='breakfast')
+
+    def _subscribe_all(self):
+        for follower in self.followers:
+            self.client.force_authenticate(follower)
+            response = self.client.post(
+                f'/api/users/{self.author.id}/subscribe/'
+            )
+            self.assertEqual(response.status_code, HTTPStatus.CREATED)
+
+    def _feed_ids(self, user, **params):
+        self.client.force_authenticate(user)
+        response = self.client.get('/api/recipes/feed/', params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_subscribe_backfills_and_new_recipes_fan_out(self):
+        self._subscribe_all()
+        first, _, third = self.old_recipes
+        self.assertEqual(
+            self._feed_ids(self.followers[0]), [third.id, first.id]
+        )
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/recipes/', {
+                'ingredients': [{'id': self.ingredient.id, 'amount': 2}],
+                'tags': [self.tag.id],
+                'name': 'Омлет',
+                'text': 'Описание',
+                'cooking_time': 5,
+                'image': None,
+            }, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        new_id = response.data['id']
+        self.assertEqual(
+            FeedEntry.objects.filter(recipe_id=new_id).count(), 3
+        )
+        for follower in self.followers:
+            self.assertEqual(
+                self._feed_ids(follower), [new_id, third.id, first.id]
+            )
+        self.assertEqual(self._feed_ids(self.other), [])
+
+    def test_feed_uses_cursor_pagination_and_unsubscribe_trims(self):
+        self._subscribe_all()
+        reader = self.followers[0]
+        self.client.force_authenticate(reader)
+        response = self.client.get('/api/recipes/feed/', {'limit': 1})
+        self.assertIn('cursor=', response.data['next'])
+        self.assertNotIn('count', response.data)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [self.old_recipes[0].id]
+        )
+        self.client.delete(f'/api/users/{self.author.id}/subscribe/')
+        self.assertEqual(self._feed_ids(reader), [])
+        self.assertEqual(
+            FeedEntry.objects.filter(user__in=self.followers[1:]).count(), 4
+        )
+
+    def test_deleting_subscriptions_outside_the_api_trims(self):
+        self._subscribe_all()
+        first, second, _ = self.followers
+        Subscribe.objects.filter(subscriber=first).delete()
+        second.delete()
+        self.assertEqual(self._feed_ids(first), [])
+        self.assertEqual(
+            FeedEntry.objects.filter(author=self.author).count(), 2
+        )
+
+    def test_rebuild_feed_repairs_dropped_fan_out(self):
+        self._subscribe_all()
+        reader = self.followers[0]
+        FeedEntry.objects.filter(user=reader).delete()
+        FeedEntry.objects.create(
+            user=reader, recipe=self.old_recipes[1], author=self.other
+        )
+        out = StringIO()
+        call_command('rebuild_feed', stdout=out)
+        self.assertIn('Removed stale feed entries: 1', out.getvalue())
+        self.assertIn('Backfilled subscriptions: 3', out.getvalue())
+        first, _, third = self.old_recipes
+        self.assertEqual(self._feed_ids(reader), [third.id, first.id])
+
+    def test_feed_requires_authentication(self):
+        response = APIClient().get('/api/recipes/feed/')
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+
+class AnonymousPageCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = CustomUser.objects.create_user(
+            email='host@example.com', username='host',
+            first_name='Анна', last_name='Каренина', password='pass'
+        )
+        self.tags = [
+            Tag.objects.create(name=f'Тег {i}', slug=f'tag-{i}')
+            for i in range(2)
+        ]
+        self.recipe = Recipe.objects.create(
+            author=self.author, name='Окрошка', text='Описание',
+            cooking_time=15
+        )
+        self.recipe.tags.set(self.tags)
+        self.client = APIClient()
+
+    def _get(self, path, params=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path, params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response, len(context.captured_queries)
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        self._get('/api/recipes/', {'tags': ['tag-0', 'tag-1']})
+        response, queries = self._get(
+            '/api/recipes/', {'tags': ['tag-1', 'tag-0'], 'utm': 'x'}
+        )
+        self.assertEqual(queries, 0)
+        self.assertEqual(response.data['results'][0]['name'], 'Окрошка')
+        self._get(f'/api/recipes/{self.recipe.id}/')
+        _, queries = self._get(f'/api/recipes/{self.recipe.id}/')
+        self.assertEqual(queries, 0)
+
+    def test_writes_bump_the_recipe_version(self):
+        self._get('/api/recipes/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.force_login(self.author)
+        self.client.logout()
+        _, queries = self._get('/api/recipes/')
+        self.assertEqual(queries, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            CustomUser.objects.create_user(
+                email='new@example.com', username='new',
+                first_name='Новый', last_name='Пользователь', password='pass'
+            )
+            self.author.set_password('changed')
+            self.author.save()
+        _, queries = self._get('/api/recipes/')
+        self.assertEqual(queries, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.tags.remove(self.tags[0])
+        response, queries = self._get('/api/recipes/')
+        self.assertGreater(queries, 0)
+        self.assertEqual(len(response.data['results'][0]['tags']), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.first_name = 'Анастасия'
+            self.author.save()
+        response, _ = self._get('/api/recipes/')
+        self.assertEqual(
+            response.data['results'][0]['author']['first_name'], 'Анастасия'
+        )
+
+    def test_authenticated_requests_bypass_the_cache(self):
+        self.client.force_authenticate(self.author)
+        self._get('/api/recipes/')
+        _, queries = self._get('/api/recipes/')
+        self.assertGreater(queries, 0)
+
+
+class SqlInspectorTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = CustomUser.objects.create_user(
+            email='dba@example.com', username='dba',
+            first_name='Пётр', last_name='Петров', password='pass'
+        )
+        self.recipes = [
+            Recipe.objects.create(
+                author=self.author, name=f'Рецепт {i}', text='Описание',
+                cooking_time=10
+            )
+            for i in range(3)
+        ]
+        self.client = APIClient()
+
+    @override_settings(SQL_INSPECTOR_SAMPLE_RATE=1)
+    def test_sampled_request_gets_server_timing_and_log_line(self):
+        with self.assertLogs('backend.sql', 'INFO') as logs:
+            response = self.client.get('/api/recipes/')
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$'
+        )
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['path'], '/api/recipes/')
+        self.assertEqual(line['status'], HTTPStatus.OK)
+        self.assertGreater(line['queries'], 0)
+        self.assertEqual(line['repeated'], [])
+
+    @override_settings(SQL_INSPECTOR_SAMPLE_RATE=0)
+    def test_unsampled_request_is_untouched(self):
+        response = self.client.get('/api/recipes/')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(
+        SQL_INSPECTOR_SAMPLE_RATE=1, SQL_INSPECTOR_REPEAT_THRESHOLD=2
+    )
+    def test_repeated_fingerprints_are_flagged(self):
+        def view(request):
+            for recipe in self.recipes:
+                Recipe.objects.filter(pk=recipe.pk).exists()
+            Recipe.objects.filter(
+                pk__in=[recipe.pk for recipe in self.recipes]
+            ).exists()
+            return HttpResponse()
+
+        with self.assertLogs('backend.sql', 'WARNING') as logs:
+            QueryInspectorMiddleware(view)(RequestFactory().get('/n+1/'))
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['queries'], 4)
+        self.assertEqual(len(line['repeated']), 1)
+        self.assertEqual(line['repeated'][0]['count'], 3)
+        self.assertNotIn(str(self.recipes[0].pk), line['repeated'][0]['sql'])
+
+    @override_settings(SQL_INSPECTOR_SAMPLE_RATE=1)
+    def test_metrics_and_inspector_share_one_query_wrapper(self):
+        wrappers = []
+
+        def view(request):
+            wrappers.append(len(connection.execute_wrappers))
+            Recipe.objects.exists()
+            return HttpResponse()
+
+        middleware = PrometheusMiddleware(QueryInspectorMiddleware(view))
+        with self.assertLogs('backend.sql', 'INFO') as logs:
+            response = middleware(RequestFactory().get('/shared/'))
+        self.assertEqual(wrappers, [1])
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['queries'], 1)
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+    def test_fingerprint_strips_literals(self):
+        self.assertEqual(
+            fingerprint(
+                "SELECT  \"T3\".\"id\" FROM t WHERE a IN (%s, %s, %s) "
+                "AND b = 'it''s' LIMIT 21"
+            ),
+            'SELECT "T3"."id" FROM t WHERE a IN (...) AND b = ? LIMIT ?'
+        )
+
+    @override_settings(SQL_INSPECTOR_SAMPLE_RATE=1)
+    def test_streaming_responses_are_reported_after_the_body(self):
+        self.client.force_authenticate(self.author)
+        response = self.client.get('/api/recipes/download_shopping_cart/')
+        with self.assertLogs('backend.sql', 'INFO') as logs:
+            b''.join(response.streaming_content)
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertGreater(line['queries'], 0)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            email='ops@example.com', username='ops',
+            first_name='Иван', last_name='Иванов', password='pass'
+        )
+        self.client = APIClient()
+
+    def _sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_labelled_by_route_name(self):
+        requests = self._sample(
+            'foodgram_requests_total',
+            route='recipe-list', method='GET', status='200'
+        )
+        latency = self._sample(
+            'foodgram_request_duration_seconds_count',
+            route='recipe-list', method='GET'
+        )
+        unmatched = self._sample(
+            'foodgram_requests_total',
+            route='unmatched', method='GET', status='404'
+        )
+        self.client.get('/api/recipes/')
+        self.client.get('/api/no/such/path/')
+        self.assertEqual(
+            self._sample(
+                'foodgram_requests_total',
+                route='recipe-list', method='GET', status='200'
+            ),
+            requests + 1
+        )
+        self.assertEqual(
+            self._sample(
+                'foodgram_request_duration_seconds_count',
+                route='recipe-list', method='GET'
+            ),
+            latency + 1
+        )
+        self.assertEqual(
+            self._sample(
+                'foodgram_requests_total',
+                route='unmatched', method='GET', status='404'
+            ),
+            unmatched + 1
+        )
+
+    def test_query_counts_sizes_and_cache_lookups(self):
+        queries = self._sample(
+            'foodgram_request_db_queries_sum', route='recipe-list'
+        )
+        size = self._sample(
+            'foodgram_response_size_bytes_sum', route='recipe-list'
+        )
+        hits = self._sample(
+            'foodgram_cache_lookups_total', cache='page', result='hit'
+        )
+        self.client.get('/api/recipes/')
+        response = self.client.get('/api/recipes/')
+        self.assertGreater(
+            self._sample(
+                'foodgram_request_db_queries_sum', route='recipe-list'
+            ),
+            queries
+        )
+        self.assertGreaterEqual(
+            self._sample(
+                'foodgram_response_size_bytes_sum', route='recipe-list'
+            ),
+            size + 2 * len(response.content)
+        )
+        self.assertEqual(
+            self._sample(
+                'foodgram_cache_lookups_total', cache='page', result='hit'
+            ),
+            hits + 1
+        )
+
+    def test_streamed_responses_are_measured_after_the_body(self):
+        self.client.force_authenticate(self.user)
+        count = self._sample(
+            'foodgram_response_size_bytes_count',
+            route='download_shopping_cart'
+        )
+        response = self.client.get('/api/recipes/download_shopping_cart/')
+        self.assertEqual(
+            self._sample(
+                'foodgram_response_size_bytes_count',
+                route='download_shopping_cart'
+            ),
+            count
+        )
+        b''.join(response.streaming_content)
+        self.assertEqual(
+            self._sample(
+                'foodgram_response_size_bytes_count',
+                route='download_shopping_cart'
+            ),
+            count + 1
+        )
+
+    def test_metrics_endpoint_requires_token(self):
+        with override_settings(METRICS_TOKEN=None):
+            response = self.client.get('/api/_metrics')
+            self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+        with override_settings(METRICS_TOKEN='secret'):
+            response = self.client.get(
+                '/api/_metrics', HTTP_AUTHORIZATION='Bearer wrong'
+            )
+            self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+            response = self.client.get(
+                '/api/_metrics', HTTP_AUTHORIZATION='Bearer secret'
+            )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn(b'foodgram_requests_total', response.content)
+
+
+class RecipeSearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = CustomUser.objects.create_user(
+            email='cook@example.com', username='cook',
+            first_name='Марфа', last_name='Васильева', password='pass'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.author)
+
+    def _create(self, name, text='Описание'):
+        return Recipe.objects.create(
+            author=self.author, name=name, text=text, cooking_time=30
+        )
+
+    def _search(self, term):
+        response = self.client.get('/api/recipes/', {'search': term})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_empty_query_is_passed_through(self):
+        recipes = [self._create(f'Рецепт {index}') for index in range(3)]
+        response = self.client.get('/api/recipes/')
+        expected = [recipe['id'] for recipe in response.data['results']]
+        self.assertEqual(
+            sorted(expected), sorted(recipe.id for recipe in recipes)
+        )
+        for term in ('', '   '):
+            with self.subTest(term=term):
+                self.assertEqual(self._search(term), expected)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+    def test_stemmed_match(self):
+        dumplings = self._create('Пельмени домашние')
+        baked = self._create('Запеканка', text='Запекать в духовке час')
+        self._create('Окрошка')
+        self.assertEqual(self._search('пельменей'), [dumplings.id])
+        self.assertEqual(self._search('духовка'), [baked.id])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+    def test_trigram_typo_match(self):
+        borscht = self._create('Борщ украинский')
+        self._create('Окрошка')
+        self.assertEqual(self._search('Барщ украинский'), [borscht.id])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+    def test_name_matches_rank_above_text_matches(self):
+        in_name = self._create('Тыква с мёдом')
+        in_text = self._create('Суп-пюре', text='Добавить тыкву и сливки')
+        self.assertEqual(self._search('тыква'), [in_name.id, in_text.id])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+    def test_vector_follows_name_and_text_edits(self):
+        recipe = self._create('Салат')
+        self.assertEqual(self._search('окрошка'), [])
+        recipe.name = 'Окрошка'
+        recipe.save()
+        self.assertEqual(self._search('окрошка'), [recipe.id])
+        recipe.text = 'Нарезать редис'
+        recipe.save(update_fields=['text'])
+        self.assertEqual(self._search('редис'), [recipe.id])
@@ -15,6 +15,21 @@ urlpatterns = [
         views.DownloadShoppingCartView.as_view(),
         name='download_shopping_cart'
     ),
+    path(
+        'recipes/favorite/bulk/',
+        views.FavoriteBulkView.as_view(),
+        name='favorite_bulk'
+    ),
+    path(
+        'recipes/shopping_cart/bulk/',
+        views.ShoppingCartBulkView.as_view(),
+        name='shopping_cart_bulk'
+    ),
+    path(
+        'recipes/shopping_cart/',
+        views.ShoppingCartView.as_view(),
+        name='shopping_cart'
+    ),
     path(
         'recipes/<int:id>/favorite/',
         RecipeFavoriteViewSet.as_view(
@@ -29,6 +44,11 @@ urlpatterns = [
         views.RecipeShoppingCartView.as_view(),
         name='recipe_shopping_cart'
     ),
+    path(
+        'recipes/<int:id>/image/',
+        views.RecipeImageView.as_view(),
+        name='recipe_image'
+    ),
     path(
         'recipes/<int:pk>/',
         views.RecipeViewSet.as_view({
@@ -0,0 +1,30 @@
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+VERSION_KEY = 'version:{}'
+
+
+def get_version(name):
+    key = VERSION_KEY.format(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, settings.VERSION_STAMP_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(*names):
+    cache.set_many(
+        {VERSION_KEY.format(name): uuid4().hex for name in names},
+        settings.VERSION_STAMP_TIMEOUT
+    )
+
+
+def shopping_cart_version_name(user_id):
+    return f'shopping_cart:{user_id}'
+
+
+def bump_shopping_cart_versions(user_ids):
+    bump_version(*(shopping_cart_version_name(pk) for pk in user_ids))
@@ -1,50 +1,110 @@
+from django.conf import settings
 from django.db import IntegrityError, transaction
-from django.http import Http404, HttpResponse
-from rest_framework import filters, status
+from django.core.cache import cache
+from django.db.models import Prefetch, Sum
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.exceptions import (AuthenticationFailed, NotFound,
                                        ParseError, PermissionDenied)
 from rest_framework.generics import get_object_or_404
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import (AllowAny, IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
 from rest_framework.status import HTTP_201_CREATED, HTTP_204_NO_CONTENT
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from backend.metrics import record_cache_lookup
+from recipes.feed import fan_out_recipe
+from recipes.images import image_changed
 from recipes.models import (FavoriteRecipe, Ingredient, Recipe,
-                            RecipeIngredient, ShoppingCard, Tag)
+                            RecipeIngredient, ShoppingCard,
+                            ShoppingCartTotal, Tag)
+from recipes.tasks import submit_on_commit
+from users.models import CustomUser
 
-from .filters import IngredientFilterBackend
-from .pagination import CustomPagination
-from .serializers import (IngredientSerializer, RecipeFavoriteSerializer,
+from .catalog import CachedCatalogMixin
+from .exporters import DEFAULT_EXPORT_FORMAT, EXPORTERS
+from .filters import RecipeOrderingFilter, RecipeSearchFilter
+from .images import ImageTooLarge, LengthRequired, LimitedUploadHandler
+from .ingredient_index import ingredient_index
+from .page_cache import AnonymousPageCacheMixin
+from .pagination import (CustomCursorPagination, CustomPagination,
+                         FeedPagination)
+from .serializers import (IngredientSerializer, RecipeBulkSerializer,
+                          RecipeFavoriteSerializer, RecipeImageSerializer,
                           RecipeSerializer, TagSerializer)
+from .versions import (bump_shopping_cart_versions, get_version,
+                       shopping_cart_version_name)
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+def cache_rendered(chunks, cache_key):
+    rendered = []
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        rendered.append(chunk)
+        yield chunk
+    cache.set(cache_key, b''.join(rendered))
+
+
+class TagViewSet(CachedCatalogMixin, ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (AllowAny,)
     pagination_class = None
+    catalog_name = 'tags'
 
 
-class IngredientViewSet(ReadOnlyModelViewSet):
+class IngredientViewSet(CachedCatalogMixin, ReadOnlyModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (AllowAny,)
-    filter_backends = (IngredientFilterBackend,)
     pagination_class = None
+    catalog_name = 'ingredients'
+
+    def get_limit(self):
+        limit = self.request.query_params.get('limit')
+        if limit is None:
+            return None
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ParseError(detail='Invalid value for limit')
+        if limit < 1:
+            raise ParseError(detail='Invalid value for limit')
+        return limit
+
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name:
+            return super().list(request, *args, **kwargs)
+        return Response(ingredient_index.search(name, self.get_limit()))
 
 
-class RecipeViewSet(ModelViewSet):
-    queryset = Recipe.objects.select_related('author').prefetch_related('tags')
+class RecipeViewSet(AnonymousPageCacheMixin, ModelViewSet):
+    queryset = Recipe.objects.select_related('author').prefetch_related(
+        'tags',
+        Prefetch(
+            'recipe_ingredients',
+            queryset=RecipeIngredient.objects.select_related('ingredient')
+        )
+    ).defer('search_vector')
     serializer_class = RecipeSerializer
-    filter_backends = (filters.SearchFilter,)
+    filter_backends = (RecipeSearchFilter, RecipeOrderingFilter)
     filterset_fields = ['author__id', 'tags__name']
     permission_classes = [IsAuthenticatedOrReadOnly]
-    pagination_class = CustomPagination
+    pagination_class = FeedPagination
+    page_cache_version = 'recipes'
+    page_cache_params = (
+        'author', 'cursor', 'limit', 'ordering', 'page', 'pagination',
+        'search', 'tags',
+    )
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().with_user_flags(self.request.user)
         author = self.request.query_params.get('author', None)
         if author is not None:
             queryset = queryset.filter(author__id=author)
@@ -53,32 +113,52 @@ class RecipeViewSet(ModelViewSet):
         if tags:
             queryset = queryset.filter(tags__slug__in=tags).distinct()
         is_favorited = self.request.query_params.get('is_favorited', '0')
-        try:
-            if is_favorited == '1' and self.request.user.is_authenticated:
-                favorited_recipes = FavoriteRecipe.objects.filter(
-                    user=self.request.user
-                ).values_list('recipe_id', flat=True)
-                queryset = queryset.filter(id__in=favorited_recipes)
-        except (ValueError, TypeError):
-            raise ParseError(detail='Invalid value for is_favorited')
+        if is_favorited == '1' and self.request.user.is_authenticated:
+            queryset = queryset.filter(is_favorited=True)
 
         is_in_shopping_cart = self.request.query_params.get(
             'is_in_shopping_cart', '0')
-        try:
-            if (is_in_shopping_cart == '1'
-                    and self.request.user.is_authenticated):
-                shopping_cart_recipes = ShoppingCard.objects.filter(
-                    user=self.request.user
-                ).values_list('recipe_id', flat=True)
-                queryset = queryset.filter(id__in=shopping_cart_recipes)
-        except (ValueError, TypeError):
-            raise ParseError(detail='Invalid value for is_in_shopping_cart')
+        if is_in_shopping_cart == '1' and self.request.user.is_authenticated:
+            queryset = queryset.filter(is_in_shopping_cart=True)
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    @action(detail=False, pagination_class=CustomPagination)
+    def trending(self, request):
+        queryset = self.get_queryset().filter(
+            trending__isnull=False
+        ).order_by('-trending__score', '-id')
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(
+        detail=False,
+        permission_classes=[IsAuthenticated],
+        pagination_class=CustomCursorPagination
+    )
+    def feed(self, request):
+        queryset = self.get_queryset().filter(feed_entries__user=request.user)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def _refresh_instance(self, serializer):
+        serializer.instance = self.get_queryset().get(
+            pk=serializer.instance.pk
+        )
+
     def update(self, request, *args, **kwargs):
-        user = request.user
+        partial = kwargs.pop('partial', False)
         instance = self.get_object()
-        if user != instance.author:
+        if request.user != instance.author:
             raise PermissionDenied
 
         ingredients = request.data.get('ingredients')
@@ -87,29 +167,12 @@ class RecipeViewSet(ModelViewSet):
         if not (ingredients and tags):
             raise ParseError("Ingredient and tags are required.")
 
-        if ingredients:
-            ingredient_ids = [ingredient['id'] for ingredient in ingredients]
-            ingredient_objs = Ingredient.objects.in_bulk(ingredient_ids)
-            for ingredient_data in ingredients:
-                ingredient_id = ingredient_data['id']
-                ingredient_obj = ingredient_objs.get(ingredient_id)
-                if ingredient_obj:
-                    (
-                        recipe_ingredient, created
-                    ) = RecipeIngredient.objects.get_or_create(
-                        recipe=instance,
-                        ingredient=ingredient_obj,
-                        defaults={'amount': ingredient_data['amount']}
-                    )
-
-                    if not created:
-                        recipe_ingredient.amount = ingredient_data['amount']
-                        recipe_ingredient.save()
-
-        instance.tags.clear()
-        instance.tags.set(tags)
-
-        return super().update(request, *args, **kwargs)
+        serializer = self.get_serializer(
+            instance, data=request.data, partial=partial
+        )
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        return Response(serializer.data)
 
     def destroy(self, request, *args, **kwargs):
         user = request.user
@@ -121,116 +184,277 @@ class RecipeViewSet(ModelViewSet):
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
+        submit_on_commit(fan_out_recipe, serializer.instance.pk)
+        image_changed(serializer.instance)
+        self._refresh_instance(serializer)
 
+    def perform_update(self, serializer):
+        serializer.save()
+        self._refresh_instance(serializer)
 
-class RecipeFavoriteViewSet(ModelViewSet):
+    def perform_destroy(self, instance):
+        instance.delete()
 
-    @action(detail=True, permission_classes=[IsAuthenticated])
-    def favorite(self, request, id=None):
-        if not request.user.is_authenticated:
-            raise AuthenticationFailed
+
+class RecipeRelationMixin:
+    relation_model = None
+    counter_field = None
+
+    def lock_relations(self, user):
+        pass
+
+    def lock_recipes(self, recipe_ids):
+        return set(Recipe.objects.select_for_update(no_key=True).filter(
+            pk__in=recipe_ids
+        ).order_by('pk').values_list('pk', flat=True))
+
+    def relations_bulk_created(self, user, recipe_ids):
+        Recipe.objects.filter(pk__in=recipe_ids).change_counter(
+            self.counter_field, 1
+        )
+
+    def add_relation(self, user, recipe_id):
         try:
-            recipe = get_object_or_404(Recipe, pk=id)
-            if FavoriteRecipe.objects.filter(
-                    recipe=recipe,
-                    user=self.request.user
-            ).exists():
-                raise ParseError
             with transaction.atomic():
-                FavoriteRecipe.objects.create(
-                    recipe=recipe,
-                    user=self.request.user
+                self.lock_relations(user)
+                recipe = Recipe.objects.select_for_update(
+                    no_key=True
+                ).only(*RecipeFavoriteSerializer.Meta.fields).get(
+                    pk=recipe_id
                 )
-        except Http404:
+                self.relation_model.objects.create(recipe=recipe, user=user)
+        except (IntegrityError, Recipe.DoesNotExist):
+            raise ParseError
+        return recipe
+
+    def remove_relation(self, user, recipe_id):
+        with transaction.atomic():
+            self.lock_relations(user)
+            if not self.lock_recipes([recipe_id]):
+                raise NotFound
+            deleted, _ = self.relation_model.objects.filter(
+                recipe_id=recipe_id,
+                user=user
+            ).delete()
+        if not deleted:
             raise ParseError
+
+    def bulk_change_relations(self, user, add, remove):
+        relations = self.relation_model.objects.filter(user=user)
+        with transaction.atomic():
+            self.lock_relations(user)
+            found = self.lock_recipes(add + remove)
+            present = set(relations.filter(
+                recipe_id__in=found
+            ).values_list('recipe_id', flat=True))
+            added = [pk for pk in add if pk in found and pk not in present]
+            removed = [pk for pk in remove if pk in present]
+            if added:
+                self.relation_model.objects.bulk_create(
+                    [
+                        self.relation_model(recipe_id=pk, user=user)
+                        for pk in added
+                    ],
+                    ignore_conflicts=True
+                )
+                self.relations_bulk_created(user, added)
+            if removed:
+                relations.filter(recipe_id__in=removed).delete()
+        results = []
+        for pk in add:
+            if pk in present:
+                outcome = 'already_added'
+            elif pk in found:
+                outcome = 'added'
+            else:
+                outcome = 'not_found'
+            results.append({'id': pk, 'action': 'add', 'status': outcome})
+        for pk in remove:
+            outcome = 'removed' if pk in present else 'not_added'
+            results.append({'id': pk, 'action': 'remove', 'status': outcome})
+        return results
+
+
+class RecipeFavoriteViewSet(RecipeRelationMixin, ModelViewSet):
+    relation_model = FavoriteRecipe
+    counter_field = 'favorites_count'
+
+    @action(detail=True, permission_classes=[IsAuthenticated])
+    def favorite(self, request, id=None):
+        if not request.user.is_authenticated:
+            raise AuthenticationFailed
+        recipe = self.add_relation(request.user, id)
         serializer = RecipeFavoriteSerializer(recipe)
         return Response(serializer.data, status=HTTP_201_CREATED)
 
     @action(detail=True, permission_classes=[IsAuthenticated])
     def favorite_delete(self, request, id=None):
-        user = self.request.user
-        if not user.is_authenticated:
+        if not request.user.is_authenticated:
             raise AuthenticationFailed
-        try:
-            recipe = get_object_or_404(Recipe, pk=id)
-            with transaction.atomic():
-                favorite_recipe = FavoriteRecipe.objects.filter(
-                    recipe=recipe,
-                    user=user
-                )
-                if not favorite_recipe.exists():
-                    raise ParseError
-                favorite_recipe.delete()
-        except Http404:
-            raise NotFound
+        self.remove_relation(request.user, id)
         return Response(status=HTTP_204_NO_CONTENT)
 
 
+class RecipeBulkRelationView(RecipeRelationMixin, APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = RecipeBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = self.bulk_change_relations(
+            request.user, **serializer.validated_data
+        )
+        return Response({'results': results})
+
+
+class FavoriteBulkView(RecipeBulkRelationView):
+    relation_model = FavoriteRecipe
+    counter_field = 'favorites_count'
+
+
+class IgnoreFormatContentNegotiation(DefaultContentNegotiation):
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
 class DownloadShoppingCartView(APIView):
+    permission_classes = [IsAuthenticated]
+    content_negotiation_class = IgnoreFormatContentNegotiation
+
+    def get_exporter(self):
+        export_format = self.request.query_params.get(
+            'format', DEFAULT_EXPORT_FORMAT
+        )
+        try:
+            return EXPORTERS[export_format]
+        except KeyError:
+            raise ParseError(
+                f'Неподдерживаемый формат: {export_format}. '
+                f'Доступные форматы: {", ".join(EXPORTERS)}'
+            )
+
+    def get_rows(self):
+        return ShoppingCartTotal.objects.filter(
+            user=self.request.user
+        ).values(
+            'ingredient__name',
+            'ingredient__measurement_unit'
+        ).annotate(
+            amount=Sum('total_amount')
+        ).values_list(
+            'ingredient__name',
+            'amount',
+            'ingredient__measurement_unit'
+        ).order_by(
+            'ingredient__name', 'ingredient__measurement_unit'
+        ).iterator()
+
+    def get_cache_key(self, exporter):
+        user_id = self.request.user.pk
+        return 'shopping_list:{}:{}:{}:{}'.format(
+            user_id,
+            get_version(shopping_cart_version_name(user_id)),
+            get_version('ingredients'),
+            exporter.extension
+        )
+
     def get(self, request):
-        ing_am_un = {}
-        user = self.request.user
-        shopping_carts = ShoppingCard.objects.filter(user=user)
-        for shopping_cart in shopping_carts:
-            recipes = RecipeIngredient.objects.filter(
-                recipe=shopping_cart.recipe.id
+        exporter = self.get_exporter()
+        cache_key = self.get_cache_key(exporter)
+        content = record_cache_lookup('shopping_list', cache.get(cache_key))
+        if content is not None:
+            response = HttpResponse(
+                content, content_type=exporter.content_type
             )
-            for recipe in recipes:
-                ingredient = recipe.ingredient
-                if ingredient is not None:
-                    try:
-                        ingredient_str = str(ingredient)
-                    except Exception as e:
-                        ingredient_str = f'Error {e}'
-                    amount = recipe.amount
-                    measurement_unit = recipe.ingredient.measurement_unit
-                    if ingredient_str in ing_am_un:
-                        ing_am_un[ingredient_str] = (
-                            ing_am_un[ingredient_str][0] + amount,
-                            measurement_unit
-                        )
-                    else:
-                        ing_am_un[ingredient_str] = (amount, measurement_unit)
-        content = ""
-        for ingredient, (amount, measurement_unit) in ing_am_un.items():
-            content += f"{ingredient}: {amount} {measurement_unit}\n"
-
-        response = HttpResponse(content, content_type='text/plain')
-        response[
-            'Content-Disposition'] = 'attachment; filename="shopping_cart.txt"'
+        else:
+            chunks = cache_rendered(
+                exporter.render(self.get_rows()), cache_key
+            )
+            if exporter.streaming:
+                response = StreamingHttpResponse(
+                    chunks, content_type=exporter.content_type
+                )
+            else:
+                response = HttpResponse(
+                    b''.join(chunks), content_type=exporter.content_type
+                )
+        response['Content-Disposition'] = (
+            f'attachment; filename="shopping_cart.{exporter.extension}"'
+        )
         return response
 
 
-class RecipeShoppingCartView(APIView):
+class ShoppingCartRelationMixin(RecipeRelationMixin):
+    relation_model = ShoppingCard
+    counter_field = 'in_carts_count'
+
+    def lock_relations(self, user):
+        CustomUser.objects.select_for_update(no_key=True).values(
+            'pk'
+        ).get(pk=user.pk)
+
+    def relations_bulk_created(self, user, recipe_ids):
+        super().relations_bulk_created(user, recipe_ids)
+        ShoppingCartTotal.objects.add_recipes([user.pk], recipe_ids)
+
+
+class RecipeShoppingCartView(ShoppingCartRelationMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, id=None):
-        try:
-            recipe = get_object_or_404(Recipe, pk=id)
-            with transaction.atomic():
-                ShoppingCard.objects.create(
-                    recipe=recipe,
-                    user=self.request.user
-                )
-        except IntegrityError:
-            raise ParseError
-        except Http404:
-            raise ParseError
+        recipe = self.add_relation(request.user, id)
         serializer = RecipeFavoriteSerializer(recipe)
         return Response(serializer.data, status=HTTP_201_CREATED)
 
     def delete(self, request, id=None):
-        user = self.request.user
-        try:
-            recipe = get_object_or_404(Recipe, pk=id)
-            with transaction.atomic():
-                shopping_card = ShoppingCard.objects.filter(
-                    recipe=recipe,
-                    user=user
-                )
-                if not shopping_card.exists():
-                    raise ParseError
-                shopping_card.delete()
-        except Http404:
-            raise NotFound
+        self.remove_relation(request.user, id)
+        return Response(status=HTTP_204_NO_CONTENT)
+
+
+class ShoppingCartBulkView(ShoppingCartRelationMixin, RecipeBulkRelationView):
+
+    def post(self, request):
+        response = super().post(request)
+        bump_shopping_cart_versions([request.user.pk])
+        return response
+
+
+class ShoppingCartView(ShoppingCartRelationMixin, APIView):
+    permission_classes = [IsAuthenticated]
+
+    def delete(self, request):
+        with transaction.atomic():
+            self.lock_relations(request.user)
+            self.relation_model.objects.filter(user=request.user).delete()
         return Response(status=HTTP_204_NO_CONTENT)
+
+
+class RecipeImageView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def put(self, request, id=None):
+        recipe = get_object_or_404(
+            Recipe.objects.only('author_id', 'image', 'image_variants'), pk=id
+        )
+        if request.user.pk != recipe.author_id:
+            raise PermissionDenied
+        old_image, old_variants = recipe.image.name, recipe.image_variants
+        content_length = request.META.get('CONTENT_LENGTH')
+        if not content_length:
+            raise LengthRequired
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            raise ParseError('Некорректный заголовок Content-Length.')
+        if content_length > settings.RECIPE_IMAGE_MAX_SIZE + 64 * 1024:
+            raise ImageTooLarge
+        request.upload_handlers = [LimitedUploadHandler(request)]
+        serializer = RecipeImageSerializer(
+            recipe, data=request.data, partial=True
+        )
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            serializer.save(image_variants={})
+            image_changed(recipe, old_image, old_variants)
+        return Response(serializer.data)
@@ -0,0 +1,18 @@
+from django.db import connection
+
+
+def lock_name(name):
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [name])
+
+
+def try_lock_name(name):
+    if connection.vendor != 'postgresql':
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_try_advisory_xact_lock(hashtext(%s))', [name]
+        )
+        return cursor.fetchone()[0]
@@ -0,0 +1,97 @@
+import os
+from time import perf_counter
+
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter,
+                               Histogram, generate_latest, multiprocess)
+
+from .middleware import QueryInspector
+
+REQUEST_LATENCY = Histogram(
+    'foodgram_request_duration_seconds',
+    'Time spent producing a response.',
+    ('route', 'method'),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+REQUESTS = Counter(
+    'foodgram_requests',
+    'Handled requests.',
+    ('route', 'method', 'status')
+)
+ERRORS = Counter(
+    'foodgram_request_errors',
+    'Requests answered with a 5xx status.',
+    ('route', 'method')
+)
+DB_QUERIES = Histogram(
+    'foodgram_request_db_queries',
+    'Database queries executed per request.',
+    ('route',),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200)
+)
+RESPONSE_SIZE = Histogram(
+    'foodgram_response_size_bytes',
+    'Response body size.',
+    ('route',),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+)
+CACHE_LOOKUPS = Counter(
+    'foodgram_cache_lookups',
+    'Application cache lookups by outcome.',
+    ('cache', 'result')
+)
+
+
+def record_cache_lookup(name, value):
+    CACHE_LOOKUPS.labels(name, 'miss' if value is None else 'hit').inc()
+    return value
+
+
+def get_route(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.route or 'unnamed'
+
+
+def render_metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+class PrometheusMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryInspector(collect_fingerprints=False)
+        request.query_inspector = queries
+        start = perf_counter()
+        with queries.installed():
+            response = self.get_response(request)
+        route = get_route(request)
+        REQUEST_LATENCY.labels(route, request.method).observe(
+            perf_counter() - start
+        )
+        REQUESTS.labels(route, request.method, response.status_code).inc()
+        if response.status_code >= 500:
+            ERRORS.labels(route, request.method).inc()
+        if response.streaming:
+            response.streaming_content = self.stream(
+                route, response.streaming_content, queries
+            )
+        else:
+            DB_QUERIES.labels(route).observe(queries.count)
+            RESPONSE_SIZE.labels(route).observe(len(response.content))
+        return response
+
+    def stream(self, route, content, queries):
+        size = 0
+        with queries.installed():
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        DB_QUERIES.labels(route).observe(queries.count)
+        RESPONSE_SIZE.labels(route).observe(size)
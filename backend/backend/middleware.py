@@ -0,0 +1,111 @@
+import json
+import logging
+import random
+import re
+from collections import Counter
+from contextlib import ExitStack, contextmanager, nullcontext
+from hashlib import sha1
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('backend.sql')
+
+PLACEHOLDER_LIST_RE = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+SPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    sql = NUMBER_RE.sub('%s', STRING_RE.sub('%s', sql))
+    sql = PLACEHOLDER_LIST_RE.sub('(...)', sql)
+    return SPACE_RE.sub(' ', sql.replace('%s', '?')).strip()
+
+
+class QueryInspector:
+    def __init__(self, collect_fingerprints=True):
+        self.count = 0
+        self.duration = 0.0
+        self.collect_fingerprints = collect_fingerprints
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += perf_counter() - start
+            self.count += 1
+            if self.collect_fingerprints:
+                self.fingerprints[fingerprint(sql)] += 1
+
+    @contextmanager
+    def installed(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+    def repeated(self, threshold):
+        return [
+            {
+                'fingerprint': sha1(sql.encode()).hexdigest()[:12],
+                'count': count,
+                'sql': sql,
+            }
+            for sql, count in self.fingerprints.most_common()
+            if count > threshold
+        ]
+
+
+class QueryInspectorMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.SQL_INSPECTOR_SAMPLE_RATE:
+            return self.get_response(request)
+        inspector = getattr(request, 'query_inspector', None)
+        owned = inspector is None
+        if owned:
+            inspector = QueryInspector()
+        inspector.collect_fingerprints = True
+        start = perf_counter()
+        with inspector.installed() if owned else nullcontext():
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = self.stream(
+                request, response, response.streaming_content, inspector,
+                start, owned
+            )
+            return response
+        total = perf_counter() - start
+        response['Server-Timing'] = (
+            f'db;dur={inspector.duration * 1000:.1f};'
+            f'desc="{inspector.count} queries", '
+            f'app;dur={total * 1000:.1f}'
+        )
+        self.report(request, response, inspector, total)
+        return response
+
+    def stream(self, request, response, content, inspector, start, owned):
+        with inspector.installed() if owned else nullcontext():
+            yield from content
+        self.report(request, response, inspector, perf_counter() - start)
+
+    def report(self, request, response, inspector, total):
+        repeated = inspector.repeated(settings.SQL_INSPECTOR_REPEAT_THRESHOLD)
+        logger.log(
+            logging.WARNING if repeated else logging.INFO,
+            json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'queries': inspector.count,
+                'db_ms': round(inspector.duration * 1000, 1),
+                'total_ms': round(total * 1000, 1),
+                'repeated': repeated,
+            })
+        )
@@ -0,0 +1,31 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+class EstimatedCountPaginator(Paginator):
+    exact_count_threshold = 10000
+
+    def estimate_count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql' or queryset.query.where:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class '
+                'WHERE oid = to_regclass(%s)',
+                [queryset.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    @cached_property
+    def count(self):
+        if hasattr(self.object_list, 'query'):
+            estimate = self.estimate_count()
+            if estimate is not None and (
+                estimate > self.exact_count_threshold
+            ):
+                return estimate
+        return super().count
@@ -1,5 +1,6 @@
 # flake8: noqa
 import os
+import sys
 
 from dotenv import load_dotenv
 
@@ -10,6 +11,8 @@ load_dotenv()
 SECRET_KEY = os.getenv('SECRET_KEY')
 
 DEBUG = os.getenv('DEBUG') == 'True'
+
+TESTING = sys.argv[1:2] == ['test']
 ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS').split(',') if os.getenv('ALLOWED_HOSTS') else []
 
 INSTALLED_APPS = [
@@ -19,6 +22,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'users.apps.UsersConfig',
     'recipes.apps.RecipesConfig',
     'api.apps.ApiConfig',
@@ -31,6 +35,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend.metrics.PrometheusMiddleware',
+    'backend.middleware.QueryInspectorMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -57,6 +63,18 @@ DATABASES = {
     }
 }
 
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+VERSION_STAMP_TIMEOUT = (
+    int(os.getenv('VERSION_STAMP_TIMEOUT', 30))
+    if CACHE_BACKEND.endswith('.LocMemCache') else None
+)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -138,5 +156,48 @@ BASE_URL = '/backend'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+PDF_FONT_DIR = os.path.join(BASE_DIR, 'backend/fonts')
+
+DEFAULT_FILE_STORAGE = 'backend.storage.ContentAddressedStorage'
+
+RECIPE_IMAGE_MAX_SIZE = int(os.getenv('RECIPE_IMAGE_MAX_SIZE', 5 * 1024 * 1024))
+RECIPE_IMAGE_MAX_SIDE = int(os.getenv('RECIPE_IMAGE_MAX_SIDE', 4096))
+RECIPE_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+RECIPE_IMAGE_VARIANT_WIDTHS = (160, 320, 640, 1280)
+
+DATA_UPLOAD_MAX_MEMORY_SIZE = RECIPE_IMAGE_MAX_SIZE * 4 // 3 + 1024 * 1024
+
 CORS_URLS_REGEX = r'^/api/.*$'
 CORS_ORIGIN_ALLOW_ALL = True
+
+BACKGROUND_TASK_WORKERS = int(os.getenv('BACKGROUND_TASK_WORKERS', 2))
+BACKGROUND_TASKS_SYNC = os.getenv('BACKGROUND_TASKS_SYNC') == 'True'
+
+TRENDING_HALF_LIFE_HOURS = int(os.getenv('TRENDING_HALF_LIFE_HOURS', 72))
+TRENDING_WEIGHTS = {'favorite': 1.0, 'shopping_cart': 2.0}
+TRENDING_COMMIT_LAG_SECONDS = 60
+
+FEED_FANOUT_BATCH_SIZE = 1000
+FEED_BACKFILL_LIMIT = 100
+
+PAGE_CACHE_TIMEOUT = int(os.getenv('PAGE_CACHE_TIMEOUT', 300))
+
+SQL_INSPECTOR_SAMPLE_RATE = 0 if TESTING else float(os.getenv('SQL_INSPECTOR_SAMPLE_RATE', 1 if DEBUG else 0.01))
+SQL_INSPECTOR_REPEAT_THRESHOLD = int(os.getenv('SQL_INSPECTOR_REPEAT_THRESHOLD', 5))
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'backend.sql': {
+            'handlers': ['console'],
+            'level': os.getenv('SQL_INSPECTOR_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
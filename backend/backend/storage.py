@@ -0,0 +1,34 @@
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from .locks import lock_name
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest[:2], digest + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        return self.save_derived(
+            self.hashed_name(name, content), content, max_length
+        )
+
+    def save_derived(self, name, content, max_length=None):
+        lock_name(name)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
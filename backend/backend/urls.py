@@ -3,10 +3,13 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
+from .views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/auth/', include('djoser.urls.authtoken')),
     path('api/users/', include('users.urls')),
+    path('api/_metrics', metrics, name='metrics'),
     path('api/', include('api.urls')),
 ]
 
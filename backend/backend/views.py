@@ -1,5 +1,22 @@
+import hmac
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .metrics import render_metrics
 
 
 def custom_page_not_found(request, exception):
     return render(request, 'backend/404.html', status=404)
+
+
+def metrics(request):
+    if not settings.METRICS_TOKEN:
+        raise Http404
+    token = request.headers.get('Authorization', '').partition('Bearer ')[2]
+    expected = settings.METRICS_TOKEN.encode()
+    if not hmac.compare_digest(token.encode(), expected):
+        return HttpResponse(status=403)
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
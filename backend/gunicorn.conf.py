@@ -0,0 +1,18 @@
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = '0.0.0.0:8000'
+
+
+def on_starting(server):
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
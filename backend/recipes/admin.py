@@ -1,7 +1,14 @@
 from django.contrib import admin
 
+from backend.paginator import EstimatedCountPaginator
+from .images import image_changed
 from .models import (FavoriteRecipe, Ingredient, Recipe, RecipeIngredient,
-                     ShoppingCard, Tag)
+                     ShoppingCard, Tag, TrendingRecipe)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Tag)
@@ -12,42 +19,81 @@ class TagAdmin(admin.ModelAdmin):
 
 
 @admin.register(Ingredient)
-class IngredientAdmin(admin.ModelAdmin):
+class IngredientAdmin(LargeTableAdmin):
     list_display = ('name', 'measurement_unit')
     list_display_links = ('name', 'measurement_unit')
     ordering = ('name', 'measurement_unit')
-    list_filter = ('name',)
+    search_fields = ('name',)
 
 
 @admin.register(RecipeIngredient)
-class RecipeIngredientAdmin(admin.ModelAdmin):
+class RecipeIngredientAdmin(LargeTableAdmin):
     list_display = ('recipe', 'ingredient')
     list_display_links = ('recipe', 'ingredient')
+    list_select_related = ('recipe', 'ingredient')
+    autocomplete_fields = ('recipe', 'ingredient')
+    search_fields = ('recipe__name',)
 
 
 @admin.register(Recipe)
-class RecipeAdmin(admin.ModelAdmin):
+class RecipeAdmin(LargeTableAdmin):
     list_display = (
         'author',
         'name',
         'count_favorite',
     )
     list_display_links = ('author', 'name')
-    ordering = ('author', 'name')
-    list_filter = ('author', 'name', 'tags')
+    list_select_related = ('author',)
+    ordering = ('-id',)
+    list_filter = ('tags',)
+    search_fields = ('name',)
+    autocomplete_fields = ('author',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('search_vector')
+
+    def save_model(self, request, obj, form, change):
+        if 'image' not in form.changed_data:
+            return super().save_model(request, obj, form, change)
+        old = Recipe.objects.only('image', 'image_variants').get(
+            pk=obj.pk
+        ) if change else None
+        obj.image_variants = {}
+        super().save_model(request, obj, form, change)
+        if old is None:
+            image_changed(obj)
+        else:
+            image_changed(obj, old.image.name, old.image_variants)
 
-    @admin.display(description='Добавлен в избранное')
+    @admin.display(
+        description='Добавлен в избранное',
+        ordering='favorites_count'
+    )
     def count_favorite(self, obj):
-        return FavoriteRecipe.objects.filter(recipe=obj).count()
+        return obj.favorites_count
 
 
 @admin.register(FavoriteRecipe)
-class FavoriteRecipeAdmin(admin.ModelAdmin):
+class FavoriteRecipeAdmin(LargeTableAdmin):
     list_display = ('recipe', 'user')
     list_display_links = ('recipe', 'user')
+    list_select_related = ('recipe', 'user')
+    autocomplete_fields = ('recipe', 'user')
+    search_fields = ('recipe__name', 'user__username')
 
 
 @admin.register(ShoppingCard)
-class ShoppingCardAdmin(admin.ModelAdmin):
+class ShoppingCardAdmin(LargeTableAdmin):
     list_display = ('recipe', 'user')
     list_display_links = ('recipe', 'user')
+    list_select_related = ('recipe', 'user')
+    autocomplete_fields = ('recipe', 'user')
+    search_fields = ('recipe__name', 'user__username')
+
+
+@admin.register(TrendingRecipe)
+class TrendingRecipeAdmin(LargeTableAdmin):
+    list_display = ('recipe', 'score', 'updated')
+    list_select_related = ('recipe',)
+    ordering = ('-score',)
+    autocomplete_fields = ('recipe',)
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from users.models import Subscribe
+
+from .models import FeedEntry, Recipe
+
+
+def fan_out_recipe(recipe_id):
+    recipe = Recipe.objects.only('author_id').filter(pk=recipe_id).first()
+    if recipe is None:
+        return
+    followers = Subscribe.objects.filter(
+        subscribed_to_id=recipe.author_id
+    ).order_by('pk')
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            batch = list(followers.select_for_update().filter(
+                pk__gt=last_pk
+            ).values_list(
+                'pk', 'subscriber_id'
+            )[:settings.FEED_FANOUT_BATCH_SIZE])
+            if not batch:
+                return
+            last_pk = batch[-1][0]
+            FeedEntry.objects.bulk_create(
+                [
+                    FeedEntry(
+                        user_id=subscriber_id,
+                        recipe_id=recipe_id,
+                        author_id=recipe.author_id
+                    )
+                    for _, subscriber_id in batch
+                ],
+                ignore_conflicts=True
+            )
+
+
+def backfill_feed(user_id, author_id):
+    recipe_ids = Recipe.objects.filter(
+        author_id=author_id
+    ).order_by('-id').values_list(
+        'pk', flat=True
+    )[:settings.FEED_BACKFILL_LIMIT]
+    FeedEntry.objects.bulk_create(
+        [
+            FeedEntry(user_id=user_id, recipe_id=pk, author_id=author_id)
+            for pk in recipe_ids
+        ],
+        ignore_conflicts=True
+    )
+
+
+def trim_feed(user_id, author_id):
+    FeedEntry.objects.filter(user_id=user_id, author_id=author_id).delete()
+
+
+def rebuild_feed():
+    removed, _ = FeedEntry.objects.filter(~Exists(Subscribe.objects.filter(
+        subscriber_id=OuterRef('user_id'),
+        subscribed_to_id=OuterRef('author_id')
+    ))).delete()
+    subscriptions = Subscribe.objects.values_list(
+        'subscriber_id', 'subscribed_to_id'
+    ).order_by('pk')
+    rebuilt = 0
+    for subscriber_id, author_id in subscriptions.iterator():
+        backfill_feed(subscriber_id, author_id)
+        rebuilt += 1
+    return removed, rebuilt
@@ -0,0 +1,106 @@
+import base64
+import os
+from functools import partial
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from api.versions import bump_version
+from backend.locks import lock_name
+from .models import Recipe
+from .tasks import submit_on_commit
+
+VARIANTS_DIR = 'uploads/variants/'
+PLACEHOLDER_WIDTH = 16
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (
+        'transparency' in image.info
+    )
+
+
+def encode(image, image_format, **options):
+    buffer = BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def resize(image, width):
+    if width >= image.width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.Resampling.LANCZOS)
+
+
+def render_variants(image):
+    widths = sorted({
+        min(width, image.width)
+        for width in settings.RECIPE_IMAGE_VARIANT_WIDTHS
+    })
+    fallback = ('png', 'PNG') if has_alpha(image) else ('jpeg', 'JPEG')
+    image = image.convert('RGBA' if has_alpha(image) else 'RGB')
+    for width in reversed(widths):
+        image = resize(image, width)
+        yield width, 'webp', encode(image, 'WEBP', quality=80, method=4)
+        yield width, fallback[0], encode(
+            image, fallback[1], quality=82, optimize=True
+        )
+    yield None, 'placeholder', encode(
+        resize(image, PLACEHOLDER_WIDTH), 'WEBP', quality=30
+    )
+
+
+@transaction.atomic
+def generate_image_variants(recipe_id):
+    recipe = Recipe.objects.only('image').filter(pk=recipe_id).first()
+    if recipe is None or not recipe.image:
+        return
+    lock_name(recipe.image.name)
+    storage = recipe.image.storage
+    stem = os.path.splitext(os.path.basename(recipe.image.name))[0]
+    with recipe.image.open('rb') as file, Image.open(file) as image:
+        largest = max(settings.RECIPE_IMAGE_VARIANT_WIDTHS)
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        variants = {'sources': []}
+        for width, image_format, content in render_variants(image):
+            if width is None:
+                variants['placeholder'] = 'data:image/webp;base64,{}'.format(
+                    base64.b64encode(content).decode()
+                )
+                continue
+            name = storage.save_derived(
+                f'{VARIANTS_DIR}{stem}-{width}.{image_format}',
+                ContentFile(content)
+            )
+            variants['sources'].append(
+                {'name': name, 'width': width, 'format': image_format}
+            )
+    if Recipe.objects.filter(pk=recipe_id, image=recipe.image.name).update(
+        image_variants=variants
+    ):
+        transaction.on_commit(partial(bump_version, 'recipes'))
+
+
+@transaction.atomic
+def delete_orphaned_image(name, variants):
+    if not name:
+        return
+    lock_name(name)
+    if Recipe.objects.filter(image=name).exists():
+        return
+    storage = Recipe._meta.get_field('image').storage
+    for source in (variants or {}).get('sources', ()):
+        storage.delete(source['name'])
+    storage.delete(name)
+
+
+def image_changed(recipe, old_name=None, old_variants=None):
+    if recipe.image:
+        submit_on_commit(generate_image_variants, recipe.pk)
+    if old_name and old_name != recipe.image.name:
+        submit_on_commit(delete_orphaned_image, old_name, old_variants)
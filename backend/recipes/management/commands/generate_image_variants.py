@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from recipes.images import generate_image_variants
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Generate resized and WebP variants for recipe images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Regenerate variants that already exist',
+        )
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='').exclude(image=None)
+        if not options['all']:
+            recipes = recipes.filter(image_variants={})
+        recipe_ids = list(recipes.values_list('pk', flat=True))
+        for recipe_id in recipe_ids:
+            generate_image_variants(recipe_id)
+        self.stdout.write(f'Processed recipes: {len(recipe_ids)}')
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from recipes.feed import rebuild_feed
+
+
+class Command(BaseCommand):
+    help = 'Drop stale feed entries and backfill every subscription'
+
+    def handle(self, *args, **options):
+        removed, rebuilt = rebuild_feed()
+        self.stdout.write(f'Removed stale feed entries: {removed}')
+        self.stdout.write(f'Backfilled subscriptions: {rebuilt}')
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import FavoriteRecipe, Recipe, ShoppingCard
+from users.models import CustomUser, Subscribe
+
+COUNTERS = (
+    (Recipe, 'favorites_count', FavoriteRecipe, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCard, 'recipe'),
+    (CustomUser, 'recipes_count', Recipe, 'author'),
+    (CustomUser, 'subscribers_count', Subscribe, 'subscribed_to'),
+)
+
+
+def related_count(model, field):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(
+                **{field: OuterRef('pk')}
+            ).order_by().values(field).annotate(
+                count=Count('pk')
+            ).values('count'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+class Command(BaseCommand):
+    help = 'Repair drift in denormalized recipe and user counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows checked per query and transaction',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report drift, do not update counters',
+        )
+
+    def reconcile(self, model, field, related_model, related_field,
+                  batch_size, dry_run):
+        actual = related_count(related_model, related_field)
+        drifted = 0
+        last_pk = 0
+        while True:
+            rows = list(
+                model.objects.filter(pk__gt=last_pk).order_by('pk').annotate(
+                    actual=actual
+                ).values_list('pk', field, 'actual')[:batch_size]
+            )
+            if not rows:
+                return drifted
+            last_pk = rows[-1][0]
+            pks = [pk for pk, stored, counted in rows if stored != counted]
+            drifted += len(pks)
+            if pks and not dry_run:
+                with transaction.atomic():
+                    model.objects.filter(pk__in=pks).update(
+                        **{field: actual}
+                    )
+
+    def handle(self, *args, **options):
+        for model, field, related_model, related_field in COUNTERS:
+            drifted = self.reconcile(
+                model, field, related_model, related_field,
+                options['batch_size'], options['dry_run']
+            )
+            self.stdout.write(
+                f'{model._meta.model_name}.{field}: drifted rows: {drifted}'
+            )
@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from recipes.models import ShoppingCard, ShoppingCartTotal
+
+
+class Command(BaseCommand):
+    help = 'Rebuild shopping cart totals from carts and recipe ingredients'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report drift, do not rebuild the table',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            expected = {
+                (user_id, ingredient_id): total_amount
+                for user_id, ingredient_id, total_amount
+                in ShoppingCard.objects.values(
+                    'user_id',
+                    'recipe__recipe_ingredients__ingredient_id'
+                ).annotate(
+                    total_amount=Sum('recipe__recipe_ingredients__amount')
+                ).values_list(
+                    'user_id',
+                    'recipe__recipe_ingredients__ingredient_id',
+                    'total_amount'
+                ).order_by()
+                if ingredient_id is not None
+            }
+            actual = {
+                (user_id, ingredient_id): total_amount
+                for user_id, ingredient_id, total_amount
+                in ShoppingCartTotal.objects.values_list(
+                    'user_id', 'ingredient_id', 'total_amount'
+                )
+            }
+            missing = expected.keys() - actual.keys()
+            extra = actual.keys() - expected.keys()
+            mismatched = {
+                key for key in expected.keys() & actual.keys()
+                if expected[key] != actual[key]
+            }
+            self.stdout.write(
+                f'Missing rows: {len(missing)}, extra rows: {len(extra)}, '
+                f'mismatched totals: {len(mismatched)}'
+            )
+            if options['dry_run']:
+                return
+            if not (missing or extra or mismatched):
+                self.stdout.write(self.style.SUCCESS('No drift found'))
+                return
+            ShoppingCartTotal.objects.all().delete()
+            ShoppingCartTotal.objects.bulk_create(
+                (
+                    ShoppingCartTotal(
+                        user_id=user_id,
+                        ingredient_id=ingredient_id,
+                        total_amount=total_amount
+                    )
+                    for (user_id, ingredient_id), total_amount
+                    in expected.items()
+                ),
+                batch_size=1000
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {len(expected)} shopping cart totals'
+        ))
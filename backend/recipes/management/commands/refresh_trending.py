@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from recipes.trending import refresh_trending
+
+
+class Command(BaseCommand):
+    help = 'Update trending recipe scores from recent favorites and carts'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Recompute all scores instead of applying new activity',
+        )
+
+    def handle(self, *args, **options):
+        updated = refresh_trending(full=options['full'])
+        if updated is None:
+            self.stdout.write('Trending refresh is already running')
+            return
+        self.stdout.write(f'Updated trending recipes: {updated}')
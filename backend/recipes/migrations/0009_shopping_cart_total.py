@@ -0,0 +1,60 @@
+# Generated by Django 3.2.16 on 2026-10-18 16:45
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def fill_shopping_cart_totals(apps, schema_editor):
+    ShoppingCard = apps.get_model('recipes', 'ShoppingCard')
+    ShoppingCartTotal = apps.get_model('recipes', 'ShoppingCartTotal')
+    totals = ShoppingCard.objects.values(
+        'user_id', 'recipe__recipe_ingredients__ingredient_id'
+    ).annotate(
+        total_amount=Sum('recipe__recipe_ingredients__amount')
+    ).filter(total_amount__gt=0).values_list(
+        'user_id',
+        'recipe__recipe_ingredients__ingredient_id',
+        'total_amount'
+    ).order_by()
+    ShoppingCartTotal.objects.bulk_create(
+        (
+            ShoppingCartTotal(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                total_amount=total_amount
+            )
+            for user_id, ingredient_id, total_amount in totals.iterator()
+            if ingredient_id is not None
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0008_auto_20240504_2112'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingCartTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_amount', models.IntegerField(verbose_name='Количество')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_cart_totals', to='recipes.ingredient', verbose_name='Игредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_cart_totals', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Итог списка покупок',
+                'verbose_name_plural': 'Итоги списков покупок',
+                'unique_together': {('user', 'ingredient')},
+            },
+        ),
+        migrations.RunPython(
+            fill_shopping_cart_totals, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.16 on 2026-10-18 16:51
+
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_ingredients(apps, schema_editor):
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    duplicates = RecipeIngredient.objects.values(
+        'recipe_id', 'ingredient_id'
+    ).annotate(
+        rows=Count('id'), keep=Min('id'), total=Sum('amount')
+    ).filter(rows__gt=1).order_by()
+    for duplicate in duplicates.iterator():
+        RecipeIngredient.objects.filter(pk=duplicate['keep']).update(
+            amount=duplicate['total']
+        )
+        RecipeIngredient.objects.filter(
+            recipe_id=duplicate['recipe_id'],
+            ingredient_id=duplicate['ingredient_id']
+        ).exclude(pk=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_recipe_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            merge_duplicate_ingredients, migrations.RunPython.noop
+        ),
+        migrations.AlterUniqueTogether(
+            name='recipeingredient',
+            unique_together={('recipe', 'ingredient')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 17:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_recipe_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, default=None, null=True, upload_to='uploads/', verbose_name='Картинка'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 17:02
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_recipe_image_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ingredient',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='ingredient_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.16 on 2026-10-18 17:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingRecipe',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='trending', serialize=False, to='recipes.recipe', verbose_name='Рецепт')),
+                ('score', models.FloatField(verbose_name='Рейтинг')),
+                ('updated', models.DateTimeField(db_index=True, verbose_name='Учтена активность до')),
+            ],
+            options={
+                'verbose_name': 'Популярный рецепт',
+                'verbose_name_plural': 'Популярные рецепты',
+            },
+        ),
+        migrations.AddField(
+            model_name='favoriterecipe',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False, verbose_name='Добавлен'),
+        ),
+        migrations.AddField(
+            model_name='shoppingcard',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False, verbose_name='Добавлен'),
+        ),
+        migrations.AddIndex(
+            model_name='trendingrecipe',
+            index=models.Index(fields=['-score', '-recipe'], name='trending_score_idx'),
+        ),
+    ]
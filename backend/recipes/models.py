@@ -1,7 +1,14 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import (MaxLengthValidator, MinLengthValidator,
                                     MinValueValidator, RegexValidator,
                                     MaxValueValidator)
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (BooleanField, Case, Exists, F, IntegerField,
+                              OuterRef, Sum, Value, When, Window)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Greatest, RowNumber
+from django.utils import timezone
 from colorfield.fields import ColorField
 
 from users.models import CustomUser
@@ -48,11 +55,56 @@ class Ingredient(models.Model):
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
         ordering = ('name',)
+        indexes = [
+            GinIndex(
+                fields=['name'],
+                name='ingredient_name_trgm_idx',
+                opclasses=['gin_trgm_ops']
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
 
+class RecipeQuerySet(models.QuerySet):
+
+    def with_user_flags(self, user):
+        if not user.is_authenticated:
+            return self.annotate(
+                is_favorited=Value(False, output_field=BooleanField()),
+                is_in_shopping_cart=Value(False, output_field=BooleanField())
+            )
+        return self.annotate(
+            is_favorited=Exists(FavoriteRecipe.objects.filter(
+                recipe=OuterRef('pk'),
+                user=user
+            )),
+            is_in_shopping_cart=Exists(ShoppingCard.objects.filter(
+                recipe=OuterRef('pk'),
+                user=user
+            ))
+        )
+
+    def change_counter(self, field, delta):
+        return self.update(**{field: Greatest(F(field) + delta, 0)})
+
+    def latest_per_author(self, author_ids, limit):
+        ranked = self.filter(author_id__in=author_ids).annotate(
+            author_rank=Window(
+                expression=RowNumber(),
+                partition_by=[F('author_id')],
+                order_by=F('id').desc()
+            )
+        ).values('id', 'author_rank').order_by()
+        sql, params = ranked.query.sql_with_params()
+        return self.filter(pk__in=RawSQL(
+            f'SELECT ranked.id FROM ({sql}) ranked '
+            f'WHERE ranked.author_rank <= %s',
+            (*params, limit)
+        ))
+
+
 class Recipe(models.Model):
     author = models.ForeignKey(
         CustomUser,
@@ -66,7 +118,13 @@ class Recipe(models.Model):
         default=None,
         blank=True,
         verbose_name='Картинка',
-
+        db_index=True,
+    )
+    image_variants = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        verbose_name='Варианты картинки'
     )
     text = models.TextField(verbose_name='Описание')
     cooking_time = models.IntegerField(
@@ -79,10 +137,44 @@ class Recipe(models.Model):
         through='RecipeIngredient'
     )
 
+    favorites_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Добавлений в избранное'
+    )
+    in_carts_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Добавлений в список покупок'
+    )
+
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ['-id']
+        indexes = [
+            GinIndex(
+                fields=['search_vector'],
+                name='recipe_search_vector_idx'
+            ),
+            GinIndex(
+                fields=['name'],
+                name='recipe_name_trgm_idx',
+                opclasses=['gin_trgm_ops']
+            ),
+            models.Index(
+                fields=['-favorites_count', '-id'],
+                name='recipe_favorites_count_idx'
+            ),
+            models.Index(
+                fields=['-in_carts_count', '-id'],
+                name='recipe_in_carts_count_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -106,6 +198,7 @@ class RecipeIngredient(models.Model):
     class Meta:
         verbose_name = 'Игредиент для рецепта'
         verbose_name_plural = 'Игредиенты для рецепта'
+        unique_together = ('recipe', 'ingredient')
 
     def __str__(self):
         return f'{self.recipe}, {self.ingredient}'
@@ -123,6 +216,12 @@ class FavoriteRecipe(models.Model):
         verbose_name='Пользователь',
         related_name='favorite_recipes'
     )
+    created = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        db_index=True,
+        verbose_name='Добавлен'
+    )
 
     class Meta:
         verbose_name = 'Избранный рецепт'
@@ -146,6 +245,12 @@ class ShoppingCard(models.Model):
         verbose_name='Пользователь',
         related_name='shopping_cards'
     )
+    created = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        db_index=True,
+        verbose_name='Добавлен'
+    )
 
     class Meta:
         verbose_name = 'Список покупок'
@@ -155,3 +260,160 @@ class ShoppingCard(models.Model):
     def __str__(self):
         if self.user.username is not None:
             return f'{self.recipe} is {self.user.username}\'s card'
+
+
+class ShoppingCartTotalManager(models.Manager):
+
+    def recipe_amounts(self, recipe_ids):
+        return dict(RecipeIngredient.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values('ingredient_id').annotate(
+            total_amount=Sum('amount')
+        ).values_list('ingredient_id', 'total_amount').order_by())
+
+    def add_amounts(self, user_ids, amounts):
+        amounts = {
+            ingredient_id: amount
+            for ingredient_id, amount in amounts.items() if amount
+        }
+        if not user_ids or not amounts:
+            return
+        with transaction.atomic():
+            self.bulk_create(
+                [
+                    self.model(
+                        user_id=user_id,
+                        ingredient_id=ingredient_id,
+                        total_amount=0
+                    )
+                    for user_id in user_ids
+                    for ingredient_id, amount in amounts.items()
+                    if amount > 0
+                ],
+                ignore_conflicts=True
+            )
+            totals = self.filter(
+                user_id__in=user_ids,
+                ingredient_id__in=amounts
+            )
+            totals.update(total_amount=F('total_amount') + Case(
+                *(
+                    When(ingredient_id=ingredient_id, then=Value(amount))
+                    for ingredient_id, amount in amounts.items()
+                ),
+                default=Value(0),
+                output_field=IntegerField()
+            ))
+            totals.filter(total_amount__lte=0).delete()
+
+    def add_recipes(self, user_ids, recipe_ids):
+        self.add_amounts(user_ids, self.recipe_amounts(recipe_ids))
+
+    def remove_recipes(self, user_ids, recipe_ids):
+        self.add_amounts(user_ids, {
+            ingredient_id: -amount
+            for ingredient_id, amount
+            in self.recipe_amounts(recipe_ids).items()
+        })
+
+    def change_recipe_amounts(self, recipe_id, amounts):
+        if not any(amounts.values()):
+            return []
+        with transaction.atomic(savepoint=False):
+            list(Recipe.objects.select_for_update(no_key=True).filter(
+                pk=recipe_id
+            ).values_list('pk', flat=True))
+            user_ids = list(ShoppingCard.objects.filter(
+                recipe_id=recipe_id
+            ).values_list('user_id', flat=True))
+            self.add_amounts(user_ids, amounts)
+        return user_ids
+
+
+class ShoppingCartTotal(models.Model):
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь',
+        related_name='shopping_cart_totals'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Игредиент',
+        related_name='shopping_cart_totals'
+    )
+    total_amount = models.IntegerField(verbose_name='Количество')
+
+    objects = ShoppingCartTotalManager()
+
+    class Meta:
+        verbose_name = 'Итог списка покупок'
+        verbose_name_plural = 'Итоги списков покупок'
+        unique_together = ('user', 'ingredient')
+
+    def __str__(self):
+        return f'{self.ingredient}: {self.total_amount}'
+
+
+class TrendingRecipe(models.Model):
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        verbose_name='Рецепт',
+        related_name='trending'
+    )
+    score = models.FloatField(verbose_name='Рейтинг')
+    updated = models.DateTimeField(
+        db_index=True,
+        verbose_name='Учтена активность до'
+    )
+
+    class Meta:
+        verbose_name = 'Популярный рецепт'
+        verbose_name_plural = 'Популярные рецепты'
+        indexes = [
+            models.Index(
+                fields=['-score', '-recipe'],
+                name='trending_score_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.recipe}: {self.score:.3f}'
+
+
+class FeedEntry(models.Model):
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        verbose_name='Подписчик',
+        related_name='feed_entries'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        verbose_name='Рецепт',
+        related_name='feed_entries'
+    )
+    author = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        verbose_name='Автор рецепта',
+        related_name='+'
+    )
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        unique_together = ('user', 'recipe')
+        indexes = [
+            models.Index(
+                fields=['user', 'author'],
+                name='feed_entry_user_author_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.recipe} in {self.user}\'s feed'
@@ -0,0 +1,42 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_TASK_WORKERS,
+                thread_name_prefix='foodgram-task'
+            )
+    return _executor
+
+
+def run_task(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Background task %s failed', func.__name__)
+    finally:
+        connections.close_all()
+
+
+def submit(func, *args):
+    if settings.BACKGROUND_TASKS_SYNC:
+        return func(*args)
+    get_executor().submit(run_task, func, *args)
+
+
+def submit_on_commit(func, *args):
+    transaction.on_commit(partial(submit, func, *args))
@@ -0,0 +1,87 @@
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from backend.locks import try_lock_name
+
+from .models import FavoriteRecipe, ShoppingCard, TrendingRecipe
+
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+EVENT_SOURCES = (
+    (FavoriteRecipe, 'favorite'),
+    (ShoppingCard, 'shopping_cart'),
+)
+
+
+def event_exponent(created):
+    half_life = timedelta(hours=settings.TRENDING_HALF_LIFE_HOURS)
+    return (
+        (created - EPOCH) / half_life * math.log(2)
+    )
+
+
+def log_sum_exp(terms):
+    largest = max(terms)
+    return largest + math.log(sum(math.exp(term - largest) for term in terms))
+
+
+def collect_activity(since, until):
+    activity = defaultdict(list)
+    for model, weight_name in EVENT_SOURCES:
+        weight = math.log(settings.TRENDING_WEIGHTS[weight_name])
+        events = model.objects.filter(created__lte=until)
+        if since is not None:
+            events = events.filter(created__gt=since)
+        for recipe_id, created in events.values_list(
+            'recipe_id', 'created'
+        ).iterator():
+            activity[recipe_id].append(weight + event_exponent(created))
+    return activity
+
+
+def refresh_trending(full=False, now=None):
+    until = (now or timezone.now()) - timedelta(
+        seconds=settings.TRENDING_COMMIT_LAG_SECONDS
+    )
+    with transaction.atomic():
+        if not try_lock_name('refresh_trending'):
+            return None
+        since = None
+        if not full:
+            since = TrendingRecipe.objects.aggregate(
+                since=Max('updated')
+            )['since']
+        activity = collect_activity(since, until)
+        if full:
+            TrendingRecipe.objects.all().delete()
+            current = {}
+        else:
+            current = dict(TrendingRecipe.objects.filter(
+                recipe_id__in=activity
+            ).values_list('recipe_id', 'score'))
+        rows = [
+            TrendingRecipe(
+                recipe_id=recipe_id,
+                score=log_sum_exp(
+                    terms + ([current[recipe_id]]
+                             if recipe_id in current else [])
+                ),
+                updated=until
+            )
+            for recipe_id, terms in activity.items()
+        ]
+        TrendingRecipe.objects.bulk_update(
+            [row for row in rows if row.recipe_id in current],
+            ['score', 'updated'],
+            batch_size=1000
+        )
+        TrendingRecipe.objects.bulk_create(
+            [row for row in rows if row.recipe_id not in current],
+            batch_size=1000
+        )
+    return len(rows)
@@ -1,5 +1,6 @@
 from django.contrib import admin
 
+from backend.paginator import EstimatedCountPaginator
 from .models import CustomUser, Subscribe
 
 admin.site.site_header = 'Панель администрирования'
@@ -20,12 +21,19 @@ class CustomUserAdmin(admin.ModelAdmin):
     )
     list_display_links = ('email', 'username')
     ordering = ('date_joined', 'username')
-    list_filter = ('email', 'username')
+    list_filter = ('is_staff', 'is_superuser')
+    search_fields = ('username', 'email')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Subscribe)
 class SubscribeAdmin(admin.ModelAdmin):
     list_display = ('subscriber', 'subscribed_to')
     list_display_links = ('subscriber', 'subscribed_to')
+    list_select_related = ('subscriber', 'subscribed_to')
     ordering = ('subscriber', 'subscribed_to')
-    list_filter = ('subscriber', 'subscribed_to')
+    autocomplete_fields = ('subscriber', 'subscribed_to')
+    search_fields = ('subscriber__username', 'subscribed_to__username')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
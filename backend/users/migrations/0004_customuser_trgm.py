@@ -0,0 +1,24 @@
+# Generated by Django 3.2.16 on 2026-10-18 17:02
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_remove_customuser_is_subscribed'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['username'], name='user_username_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['email'], name='user_email_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
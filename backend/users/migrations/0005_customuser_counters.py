@@ -0,0 +1,53 @@
+# Generated by Django 3.2.16 on 2026-10-18 17:04
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def related_count(model, field):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(
+                **{field: OuterRef('pk')}
+            ).order_by().values(field).annotate(
+                count=Count('pk')
+            ).values('count'),
+            output_field=models.IntegerField()
+        ),
+        0
+    )
+
+
+def backfill_counters(apps, schema_editor):
+    CustomUser = apps.get_model('users', 'CustomUser')
+    CustomUser.objects.update(
+        recipes_count=related_count(
+            apps.get_model('recipes', 'Recipe'), 'author'
+        ),
+        subscribers_count=related_count(
+            apps.get_model('users', 'Subscribe'), 'subscribed_to'
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_recipe_counters'),
+        ('users', '0004_customuser_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='recipes_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False, verbose_name='Количество рецептов'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='subscribers_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False, verbose_name='Количество подписчиков'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
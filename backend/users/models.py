@@ -1,4 +1,5 @@
 from django.contrib.auth.models import AbstractUser, UserManager
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 
 
@@ -37,6 +38,18 @@ class CustomUser(AbstractUser):
         max_length=254,
         unique=True,
     )
+    recipes_count = models.PositiveIntegerField(
+        default=0,
+        db_index=True,
+        editable=False,
+        verbose_name='Количество рецептов'
+    )
+    subscribers_count = models.PositiveIntegerField(
+        default=0,
+        db_index=True,
+        editable=False,
+        verbose_name='Количество подписчиков'
+    )
 
     def __str__(self):
         return self.username
@@ -44,6 +57,18 @@ class CustomUser(AbstractUser):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            GinIndex(
+                fields=['username'],
+                name='user_username_trgm_idx',
+                opclasses=['gin_trgm_ops']
+            ),
+            GinIndex(
+                fields=['email'],
+                name='user_email_trgm_idx',
+                opclasses=['gin_trgm_ops']
+            ),
+        ]
 
 
 class Subscribe(models.Model):
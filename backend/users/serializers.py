@@ -1,21 +1,28 @@
-import base64
-
-from django.core.files.base import ContentFile
 from djoser.serializers import UserCreateSerializer, UserSerializer
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 
+from api.images import Base64ImageField, ImageVariantsField
 from recipes.models import Recipe
 from .models import CustomUser, Subscribe
 
 
-class Base64ImageField(serializers.ImageField):
-    def to_internal_value(self, data):
-        if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
-        return super().to_internal_value(data)
+def get_subscribed_ids(request):
+    if request is None or not request.user.is_authenticated:
+        return frozenset()
+    subscribed_ids = getattr(request, '_subscribed_ids', None)
+    if subscribed_ids is None:
+        subscribed_ids = frozenset(Subscribe.objects.filter(
+            subscriber=request.user
+        ).values_list('subscribed_to_id', flat=True))
+        request._subscribed_ids = subscribed_ids
+    return subscribed_ids
+
+
+def is_subscribed_to(request, author):
+    if request is None or request.user.pk == author.pk:
+        return False
+    return author.pk in get_subscribed_ids(request)
 
 
 class CustomUserCreateSerializer(UserCreateSerializer):
@@ -43,21 +50,13 @@ class CustomUserSerializer(UserSerializer):
             'username',
             'first_name',
             'last_name',
-            'is_subscribed'
+            'is_subscribed',
+            'recipes_count',
+            'subscribers_count',
         ]
 
     def get_is_subscribed(self, obj):
-        if self.context['request'].user.is_authenticated:
-            if self.context['request'].path == '/users/me':
-                return False
-            else:
-                subscribed = Subscribe.objects.filter(
-                    subscriber=self.context['request'].user,
-                    subscribed_to=obj
-                )
-                return subscribed.exists()
-        else:
-            return False
+        return is_subscribed_to(self.context.get('request'), obj)
 
 
 class RecipeSubscribeSerializer(ModelSerializer):
@@ -65,6 +64,7 @@ class RecipeSubscribeSerializer(ModelSerializer):
         required=False,
         allow_null=True,
     )
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipe
@@ -72,13 +72,13 @@ class RecipeSubscribeSerializer(ModelSerializer):
             'id',
             'name',
             'image',
+            'image_variants',
             'cooking_time',
         ]
 
 
 class SubscriptionSerializer(ModelSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
     is_subscribed = serializers.SerializerMethodField()
 
     class Meta:
@@ -92,27 +92,20 @@ class SubscriptionSerializer(ModelSerializer):
             'is_subscribed',
             'recipes',
             'recipes_count',
-
+            'subscribers_count',
         ]
 
     def get_recipes(self, obj):
-        queryset = Recipe.objects.filter(author=obj.id)
-        recipes_limit = self.context.get('recipes_limit', None)
-        if recipes_limit is not None:
-            return RecipeSubscribeSerializer(
-                queryset[:int(recipes_limit)],
-                many=True
-            ).data
-        return RecipeSubscribeSerializer(queryset, many=True).data
-
-    def get_recipes_count(self, obj):
-        return Recipe.objects.filter(author=obj.id).count()
+        recipes = getattr(obj, 'recipe_previews', None)
+        if recipes is None:
+            recipes = Recipe.objects.filter(author=obj.id)
+            recipes_limit = self.context.get('recipes_limit', None)
+            if recipes_limit is not None:
+                recipes = recipes[:int(recipes_limit)]
+        return RecipeSubscribeSerializer(recipes, many=True).data
 
     def get_is_subscribed(self, obj):
-        request = self.context.get('request', None)
-        if request is not None:
-            return Subscribe.objects.filter(
-                subscriber=request.user,
-                subscribed_to=obj.id
-            ).exists()
-        return False
+        is_subscribed = getattr(obj, 'is_subscribed', None)
+        if is_subscribed is not None:
+            return is_subscribed
+        return is_subscribed_to(self.context.get('request'), obj)
@@ -1,21 +1,25 @@
 from django.db import IntegrityError, transaction
-from django.conf import settings
+from django.db.models import (BooleanField, Prefetch, Value,
+                              prefetch_related_objects)
 from djoser.views import UserViewSet
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.exceptions import NotAuthenticated, NotFound, ParseError
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import (IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
 from rest_framework.status import HTTP_204_NO_CONTENT
 
+from recipes.feed import backfill_feed
+from recipes.models import Recipe
 from .models import CustomUser, Subscribe
 from .serializers import (
     CustomUserSerializer,
     SubscriptionSerializer
 )
-from api.pagination import CustomPagination
+from api.pagination import CustomPagination, FeedPagination
+
+MAX_RECIPES_LIMIT = 100
 
 
 class CustomUserViewSet(UserViewSet):
@@ -28,6 +32,36 @@ class CustomUserViewSet(UserViewSet):
         queryset = CustomUser.objects.all()
         return queryset
 
+    def get_subscriptions_queryset(self):
+        return CustomUser.objects.annotate(
+            is_subscribed=Value(True, output_field=BooleanField())
+        )
+
+    def get_recipes_limit(self):
+        recipes_limit = self.request.query_params.get('recipes_limit')
+        if recipes_limit is None:
+            return None
+        try:
+            recipes_limit = int(recipes_limit)
+        except ValueError:
+            recipes_limit = -1
+        if not 0 <= recipes_limit <= MAX_RECIPES_LIMIT:
+            raise ParseError(
+                'recipes_limit должен быть целым числом '
+                f'от 0 до {MAX_RECIPES_LIMIT}'
+            )
+        return recipes_limit
+
+    def prefetch_recipe_previews(self, authors, recipes_limit):
+        queryset = Recipe.objects.defer('search_vector')
+        if recipes_limit is not None:
+            queryset = queryset.latest_per_author(
+                [author.pk for author in authors], recipes_limit
+            )
+        prefetch_related_objects(authors, Prefetch(
+            'recipe_set', queryset=queryset, to_attr='recipe_previews'
+        ))
+
     def get_permissions(self):
         if self.action == "me":
             self.permission_classes = [IsAuthenticated]
@@ -37,19 +71,15 @@ class CustomUserViewSet(UserViewSet):
     def subscriptions_list(self, request):
         if not self.request.user.is_authenticated:
             raise NotAuthenticated
-        subscribe_queryset = Subscribe.objects.filter(
-            subscriber=self.request.user
-        )
-        if not subscribe_queryset:
+        queryset = self.get_subscriptions_queryset().filter(
+            subscribers__subscriber=self.request.user
+        ).order_by('-id')
+        paginator = FeedPagination()
+        result_page = paginator.paginate_queryset(queryset, request, self)
+        if not result_page:
             raise NotFound('У вас нет ни одной подписки(')
-        users = []
-        for sub in subscribe_queryset:
-            subscribed_to_id = sub.subscribed_to.id
-            users.extend(CustomUser.objects.filter(pk=subscribed_to_id))
-        paginator = PageNumberPagination()
-        paginator.page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
-        result_page = paginator.paginate_queryset(users, request)
-        recipes_limit = request.query_params.get('recipes_limit')
+        recipes_limit = self.get_recipes_limit()
+        self.prefetch_recipe_previews(result_page, recipes_limit)
         serializer = SubscriptionSerializer(
             result_page,
             many=True,
@@ -63,18 +93,21 @@ class CustomUserViewSet(UserViewSet):
         subscriber = self.request.user
         if subscriber.id == id:
             raise ParseError('Вы не можете подписаться на себя')
+        recipes_limit = self.get_recipes_limit()
         try:
-            subscribed_to = CustomUser.objects.get(pk=id)
+            subscribed_to = self.get_subscriptions_queryset().get(pk=id)
             with transaction.atomic():
                 Subscribe.objects.create(
                     subscriber=subscriber,
                     subscribed_to=subscribed_to
                 )
+                backfill_feed(subscriber.pk, subscribed_to.pk)
+            subscribed_to.subscribers_count += 1
         except CustomUser.DoesNotExist:
             raise NotFound('Пользователя с таким id не существует')
         except IntegrityError:
             raise ParseError('Подписка уже существует')
-        recipes_limit = request.query_params.get('recipes_limit')
+        self.prefetch_recipe_previews([subscribed_to], recipes_limit)
         serializer = SubscriptionSerializer(
             subscribed_to,
             context={'recipes_limit': recipes_limit,